@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+if not __package__:
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks.corpus import write_corpus
+from mementomap import __VERSION__
+from mementomap.cli import MementoMapReader, build_index, compact, generate, lookup, sorted_lookup
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception as e:
+        return None
+
+
+def sample_queries(ukvsfile, count, seed=1):
+    r = random.Random(seed)
+    keys = []
+    with open(ukvsfile) as f:
+        for i, line in enumerate(f):
+            if i < count:
+                keys.append(line.split()[0])
+            elif r.randrange(i + 1) < count:
+                keys[r.randrange(count)] = line.split()[0]
+    queries = []
+    for key in keys:
+        host, path = key.split(")", 1)
+        c = r.random()
+        if c < 0.4:
+            queries.append(key)
+        elif c < 0.8:
+            queries.append(f"{key.rstrip('/')}/{r.choice(['index.html', 'a', 'img', '2019'])}")
+        else:
+            labels = host.split(",")
+            labels[-1] = f"zz{labels[-1]}"
+            queries.append(",".join(labels) + ")" + path)
+    return queries
+
+
+def bench_generate(cdxfile, mapfile, lines):
+    t = time.perf_counter()
+    with open(cdxfile, "rb") as f:
+        res = generate(f, mapfile)
+    elapsed = time.perf_counter() - t
+    return {"seconds": elapsed, "lines": lines, "lines_per_sec": lines / elapsed, "outlines": res["outlines"]}
+
+
+def bench_compact(ukvsfile, outfile, lines, hcf, pcf):
+    t = time.perf_counter()
+    with open(ukvsfile, "rb") as f:
+        res = compact(f, outfile, hcf, pcf)
+    elapsed = time.perf_counter() - t
+    return {"seconds": elapsed, "lines": lines, "lines_per_sec": lines / elapsed, "outlines": res["outlines"], "rollups": res["rollups"]}
+
+
+def bench_lookup(mapfile, queries, index):
+    latencies = []
+    found = 0
+    with MementoMapReader(mapfile, cache_size=0, index=index) as reader:
+        t = time.perf_counter()
+        for surt in queries:
+            s = time.perf_counter()
+            res = lookup(reader, surt)
+            latencies.append(time.perf_counter() - s)
+            found += res is not None
+        elapsed = time.perf_counter() - t
+    latencies.sort()
+    return {"seconds": elapsed, "lookups": len(queries), "found": found, "lookups_per_sec": len(queries) / elapsed,
+            "p50_us": percentile(latencies, 50) * 1e6, "p99_us": percentile(latencies, 99) * 1e6}
+
+
+def bench_batchlookup(mapfile, queries, presorted):
+    found = 0
+    with MementoMapReader(mapfile) as reader:
+        t = time.perf_counter()
+        if presorted:
+            for res in sorted_lookup(reader, queries):
+                found += res is not None
+        else:
+            for surt in queries:
+                found += lookup(reader, surt) is not None
+        elapsed = time.perf_counter() - t
+    return {"seconds": elapsed, "lookups": len(queries), "found": found, "lookups_per_sec": len(queries) / elapsed}
+
+
+def measure(func, *args):
+    res = func(*args)
+    res["peak_rss_kb"] = peak_rss()
+    return res
+
+
+def isolated(func, *args):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(measure, func, *args).result()
+
+
+def run_corpus(**kw):
+    write_corpus(kw["outfile"], kw["lines"], kw["seed"], kw["cdx"])
+
+
+def run_suite(**kw):
+    workdir = kw["workdir"] or tempfile.mkdtemp(prefix="mementomap-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    lines, seed = kw["lines"], kw["seed"]
+    cdxfile = os.path.join(workdir, f"corpus-{lines}-{seed}.cdx")
+    ukvsfile = os.path.join(workdir, f"corpus-{lines}-{seed}.ukvs")
+    genfile = os.path.join(workdir, "generated.ukvs")
+    mapfile = os.path.join(workdir, "compacted.ukvs")
+    corpus = {}
+    for path, cdx in [(cdxfile, True), (ukvsfile, False)]:
+        if not os.path.exists(path):
+            t = time.perf_counter()
+            write_corpus(path, lines, seed, cdx)
+            corpus[os.path.basename(path)] = time.perf_counter() - t
+    queries = sample_queries(ukvsfile, kw["lookups"], seed)
+
+    results = {}
+    results["generate"] = isolated(bench_generate, cdxfile, genfile, lines)
+    results["compact"] = isolated(bench_compact, ukvsfile, mapfile, lines, kw["hcf"], kw["pcf"])
+    results["lookup"] = isolated(bench_lookup, mapfile, queries, False)
+    build_index(mapfile)
+    results["lookup_indexed"] = isolated(bench_lookup, mapfile, queries, True)
+    results["batchlookup"] = isolated(bench_batchlookup, mapfile, queries, False)
+    results["batchlookup_sorted"] = isolated(bench_batchlookup, mapfile, sorted(queries, key=str.encode), True)
+
+    report = {
+        "version": __VERSION__,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"lines": lines, "lookups": kw["lookups"], "seed": seed, "hcf": kw["hcf"], "pcf": kw["pcf"]},
+        "corpus_seconds": corpus,
+        "results": results
+    }
+    if kw["output"] == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(kw["output"], "w") as f:
+            json.dump(report, f, indent=2)
+    if not kw["workdir"]:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    subparsers = parser.add_subparsers()
+
+    corpus_parser = subparsers.add_parser("corpus", help="Write a deterministic synthetic sorted UKVS or CDX corpus")
+    corpus_parser.add_argument("outfile", help="Output corpus file path")
+    corpus_parser.add_argument("--lines", type=int, metavar="", default=1000000, help="Number of lines to generate (default: 1000000)")
+    corpus_parser.add_argument("--seed", type=int, metavar="", default=1, help="Random seed (default: 1)")
+    corpus_parser.add_argument("--cdx", action="store_true", help="Generate CDX lines instead of UKVS")
+    corpus_parser.set_defaults(func=run_corpus)
+
+    run_parser = subparsers.add_parser("run", help="Time generate, compact, lookup and batchlookup and report JSON")
+    run_parser.add_argument("--lines", type=int, metavar="", default=1000000, help="Number of corpus lines (default: 1000000)")
+    run_parser.add_argument("--lookups", type=int, metavar="", default=10000, help="Number of lookup queries (default: 10000)")
+    run_parser.add_argument("--seed", type=int, metavar="", default=1, help="Random seed (default: 1)")
+    run_parser.add_argument("--hcf", type=float, metavar="", default=1.0, help="Host compaction factor for compact (default: 1.0)")
+    run_parser.add_argument("--pcf", type=float, metavar="", default=1.0, help="Path compaction factor for compact (default: 1.0)")
+    run_parser.add_argument("--workdir", metavar="", help="Directory to keep and reuse corpora in (default: temporary)")
+    run_parser.add_argument("--output", metavar="", default="-", help="JSON report file path or '-' for STDOUT (default: -)")
+    run_parser.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.print_help()
+        return
+    args.func(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
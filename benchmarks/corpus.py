@@ -0,0 +1,86 @@
+import random
+import time
+
+TLDS = {"com": 50, "de": 6, "edu": 4, "gov": 2, "jp": 5, "net": 10, "org": 15, "uk": 8}
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+DIGITS = "0123456789"
+
+
+def _vocabulary(r, size=4096):
+    words = set()
+    while len(words) < size:
+        words.add("".join(r.choice(LETTERS) for _ in range(r.randint(1, 6))) + r.choice(["", "", "", r.choice(DIGITS)]))
+    return sorted(words)
+
+
+class Corpus:
+    def __init__(self, lines, seed=1, cdx=False, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, **kw):
+        self.lines = lines
+        self.seed = seed
+        self.cdx = cdx
+        self.hbranch = [self._branch(ha, hk, i) for i in range(hdepth)]
+        self.pbranch = [self._branch(pa, pk, i) for i in range(pdepth)]
+        self.words = _vocabulary(random.Random(seed))
+
+    def _branch(self, a, k, i):
+        mean = max(a * (i+1) ** -k, 1.0)
+        return mean, ((i+1) / (i+2)) ** k / mean
+
+    def _children(self, r, branch):
+        mean, prob = branch
+        if r.random() >= prob:
+            return []
+        k = min(len(self.words), max(1, round(r.expovariate(1 / mean))))
+        return [self.words[i] for i in sorted(r.sample(range(len(self.words)), k))]
+
+    def _paths(self, r, key, depth=0):
+        yield key, int(r.paretovariate(1.5))
+        if depth + 1 < len(self.pbranch):
+            for seg in self._children(r, self.pbranch[depth]):
+                yield from self._paths(r, f"{key}/{seg}" if depth else f"{key}{seg}", depth + 1)
+
+    def _host(self, r, host, depth):
+        yield from self._paths(r, f"{host})/")
+        if depth + 1 < len(self.hbranch):
+            for label in self._children(r, self.hbranch[depth]):
+                yield from self._host(r, f"{host},{label}", depth + 1)
+
+    def _size(self, r, host):
+        return sum(freq if self.cdx else 1 for _, freq in self._host(r, host, 1))
+
+    def keys(self):
+        est = random.Random(self.seed + 1)
+        mean = sum(self._size(est, "com,sample") for _ in range(1000)) / 1000
+        domains = int(self.lines / mean * 1.05) + 1
+        weight = sum(TLDS.values())
+        r = random.Random(self.seed)
+        site = 0
+        tlds = sorted(TLDS)
+        for tld in tlds:
+            count = max(1, round(domains * TLDS[tld] / weight))
+            while count or tld == tlds[-1]:
+                count -= 1
+                site += 1
+                yield from self._host(r, f"{tld},s{site:09x}", 1)
+
+    def __iter__(self):
+        r = random.Random(self.seed + 2)
+        remaining = self.lines
+        for surt, freq in self.keys():
+            if not self.cdx:
+                yield f"{surt} {freq}\n"
+                remaining -= 1
+            else:
+                host, path = surt.split(")", 1)
+                url = "http://" + ".".join(reversed(host.split(","))) + path
+                for sec in sorted(r.randrange(820454400, 1577836800) for _ in range(min(freq, remaining))):
+                    yield f"{surt} {time.strftime('%Y%m%d%H%M%S', time.gmtime(sec))} {url} text/html 200 - - - 0 0 synthetic.warc.gz\n"
+                remaining -= min(freq, remaining)
+            if remaining <= 0:
+                return
+
+
+def write_corpus(outfile, lines, seed=1, cdx=False, **kw):
+    with open(outfile, "w") as f:
+        f.writelines(Corpus(lines, seed, cdx, **kw))
+    return lines
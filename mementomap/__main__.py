@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-import gzip
+import itertools
 import sys
 import os
 
@@ -9,69 +9,237 @@ if not __package__:
     sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
 from mementomap import __VERSION__
-from mementomap.cli import compact, generate, lookup
+from mementomap.binary import CODECS, is_binary
+from mementomap.cdxapi import is_remote
+from mementomap.commonlog import origtime_format, parse_field_match
+from mementomap.cli import MementoMapReader, build_bloom, build_index, cdx2hxpx, compact, convert, fromlogs, generate, lookup, merge, merge_iter, parallel_compact, parallel_generate, parse_named_path, route, route_index, sort_keys, sorted_lookup, sweep, update
+from mementomap.inputs import codec_of, open_input
+from mementomap.instrument import Telemetry, profiled
+from mementomap.server import MementoMapServer
+
+
+def summary_out(kw):
+    return sys.stderr if kw["outfile"] == "-" else sys.stdout
+
+
+def open_in(kw, infile):
+    fobj = open_input(infile, **{k: kw[k] for k in ["concurrency", "retries"] if k in kw})
+    return kw["telemetry"].wrap_input(fobj, infile) if kw["telemetry"] else fobj
+
+
+def check_bloom(kw):
+    if kw["bloom"] and (kw["outfile"] == "-" or kw["outfile"].endswith(".gz")):
+        print("A filter can only be written next to a plain output file, skipping --bloom", file=sys.stderr)
 
 
 def run_generate(**kw):
-    if kw["infile"].endswith(".gz"):
-        fobj = gzip.open(kw["infile"], "rb")
-    elif kw["infile"] == "-":
-        fobj = sys.stdin.buffer
-    else:
-        fobj = open(kw["infile"], "rb")
+    check_bloom(kw)
+    if kw["sort"]:
+        fobj = open_in(kw, kw["infile"])
+        kw["infiter"] = sort_keys(fobj, cdx=True, memory=kw["memory"] << 20, workers=kw["workers"], tmpdir=kw["tmpdir"])
+        res = compact(**kw)
+        fobj.close()
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+        return res
+    if kw["workers"] != 1 and kw["infile"] != "-" and not is_remote(kw["infile"]) and not codec_of(kw["infile"]):
+        res = parallel_generate(**kw)
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+        return res
+    fobj = open_in(kw, kw["infile"])
     kw["infiter"] = fobj
     res = generate(**kw)
     fobj.close()
-    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}')
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+    return res
+
+
+def sweep_setting(value):
+    try:
+        hcf, pcf = value.split(":")
+        return float(hcf), float(pcf)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected HCF:PCF, got {value}")
+
+
+def run_sweep(**kw):
+    if kw["outfile"] == "-":
+        raise ValueError("A sweep writes one file per setting, give an output file path")
+    if kw["workers"] != 1 and not kw["sort"]:
+        raise ValueError("A sweep reads its input in one pass, --workers only applies with --sort")
+    template = kw["outfile"]
+    if "{hcf}" not in template or "{pcf}" not in template:
+        root, ext = os.path.splitext(template[:-3] if template.endswith(".gz") else template)
+        template = root + "-{hcf}-{pcf}" + ext + (".gz" if template.endswith(".gz") else "")
+    outfiles = [template.format(hcf=hcf, pcf=pcf) for hcf, pcf in kw["sweep"]]
+    fobj = open_in(kw, kw["infile"])
+    kw["infiter"] = sort_keys(fobj, memory=kw["memory"] << 20, workers=kw["workers"], tmpdir=kw["tmpdir"]) if kw["sort"] else fobj
+    kw["outfiles"], kw["settings"] = outfiles, kw["sweep"]
+    table = sweep(**kw)
+    fobj.close()
+    print("hcf pcf inlines outlines inbytes outbytes rollups outfile")
+    for res, outfile in zip(table, outfiles):
+        print(f'{res["hcf"]} {res["pcf"]} {res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]} {outfile}')
+    return table
 
 
 def run_compact(**kw):
-    if kw["infile"].endswith(".gz"):
-        fobj = gzip.open(kw["infile"], "rb")
-    elif kw["infile"] == "-":
-        fobj = sys.stdin.buffer
-    else:
-        fobj = open(kw["infile"], "rb")
+    check_bloom(kw)
+    if kw["sweep"]:
+        return run_sweep(**kw)
+    if kw["sort"]:
+        fobj = open_in(kw, kw["infile"])
+        kw["infiter"] = sort_keys(fobj, cdx=False, memory=kw["memory"] << 20, workers=kw["workers"], tmpdir=kw["tmpdir"])
+        res = compact(**kw)
+        fobj.close()
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+        return res
+    if kw["workers"] != 1 and kw["infile"] != "-" and not codec_of(kw["infile"]):
+        res = parallel_compact(**kw)
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+        return res
+    fobj = open_in(kw, kw["infile"])
     kw["infiter"] = fobj
     res = compact(**kw)
     fobj.close()
-    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}')
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+    return res
+
+
+def run_merge(**kw):
+    fobjs = []
+    for infile in kw["infiles"]:
+        fobjs.append(open_in(kw, infile))
+    if kw["compact"]:
+        kw["infiter"] = merge_iter(fobjs)
+        res = compact(**kw)
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+    else:
+        res = merge(fobjs, kw["outfile"])
+        print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["absorbed"]}', file=summary_out(kw))
+    for fobj in fobjs:
+        fobj.close()
+    return res
+
+
+def field_match(value):
+    try:
+        return parse_field_match(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(e)
+
+
+def run_fromlogs(**kw):
+    check_bloom(kw)
+    fobjs = [open_in(kw, infile) for infile in kw["infiles"]]
+    kw["infiter"] = fobjs[0] if len(fobjs) == 1 else itertools.chain.from_iterable(fobjs)
+    kw["memory"] <<= 20
+    res = fromlogs(**kw)
+    for fobj in fobjs:
+        fobj.close()
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["rollups"]}', file=summary_out(kw))
+    return res
+
+
+def run_update(**kw):
+    check_bloom(kw)
+    fobj = open_in(kw, kw["infile"])
+    if kw["sort"]:
+        kw["infiter"] = sort_keys(fobj, cdx=True, memory=kw["memory"] << 20, workers=kw["workers"], tmpdir=kw["tmpdir"])
+    else:
+        kw["infiter"] = cdx2hxpx(fobj)
+    try:
+        res = update(kw["mmap"], **kw)
+    finally:
+        fobj.close()
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["subtrees"]}', file=summary_out(kw))
+    return res
+
+
+def run_route_index(**kw):
+    names = []
+    fobjs = []
+    for spec in kw["infiles"]:
+        name, infile = parse_named_path(spec)
+        names.append(name)
+        fobjs.append(open_in(kw, infile))
+    res = route_index(fobjs, kw["outfile"], names)
+    for fobj in fobjs:
+        fobj.close()
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["archives"]}', file=summary_out(kw))
+    return res
+
+
+def run_convert(**kw):
+    res = convert(**kw)
+    print(f'{res["inlines"]} {res["outlines"]} {res["inbytes"]} {res["outbytes"]} {res["blocks"]}', file=summary_out(kw))
+    return res
+
+
+def run_index(**kw):
+    if is_binary(kw["mmap"]):
+        print("A binary MementoMap carries its own block directory, skipping the index", file=sys.stderr)
+    else:
+        res = build_index(kw["mmap"], blocksize=kw["blocksize"])
+        print(f'{res["blocks"]} {res["inbytes"]} {res["outbytes"]}')
+    if kw["bloom"]:
+        res = build_bloom(kw["mmap"], fpr=kw["bloom"])
+        print(f'{res["keys"]} {res["inbytes"]} {res["outbytes"]}')
 
 
 def run_lookup(**kw):
-    mobj = open(kw["mmap"], "rb")
+    mobj = MementoMapReader.open_with_fallback(kw["mmap"], kw["cache"])
     kw["mmapiter"] = mobj
     res = lookup(**kw)
     mobj.close()
     if res:
         print(f'{res["surtk"]} {res["freq"]} {res["dist"]} {res["surt"]}')
+    return mobj.stats()
 
 
 def run_batchlookup(**kw):
-    mobj = open(kw["mmap"], "rb")
+    mobj = MementoMapReader.open_with_fallback(kw["mmap"], kw["cache"])
     kw["mmapiter"] = mobj
-    if kw["infile"].endswith(".gz"):
-        fobj = gzip.open(kw["infile"], "rb")
-    elif kw["infile"] == "-":
-        fobj = sys.stdin.buffer
+    fobj = open_in(kw, kw["infile"])
+    if kw["sorted"]:
+        for res in sorted_lookup(mobj, (line.strip().decode() for line in fobj)):
+            if res:
+                print(f'{res["surtk"]} {res["freq"]} {res["dist"]} {res["surt"]}')
     else:
-        fobj = open(kw["infile"], "rb")
-    for line in fobj:
-        kw["surt"] = line.strip().decode()
-        res = lookup(**kw)
-        if res:
-            print(f'{res["surtk"]} {res["freq"]} {res["dist"]} {res["surt"]}')
+        for line in fobj:
+            kw["surt"] = line.strip().decode()
+            res = lookup(**kw)
+            if res:
+                print(f'{res["surtk"]} {res["freq"]} {res["dist"]} {res["surt"]}')
     fobj.close()
     mobj.close()
+    return mobj.stats()
+
+
+def run_route(**kw):
+    mobj = MementoMapReader.open_with_fallback(kw["mmap"], kw["cache"])
+    res = route(mobj, kw["surt"])
+    mobj.close()
+    for name, hit in res.items():
+        if hit:
+            print(f'{name} {hit["surtk"]} {hit["freq"]} {hit["dist"]} {hit["surt"]}')
+    return mobj.stats()
+
+
+def run_serve(**kw):
+    MementoMapServer(kw["mmaps"], kw["cache"], kw["reload"]).serve(kw["host"], kw["port"])
 
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--telemetry", metavar="", help="Write JSON lines of progress, stage timers, and final counts to this file path or '-' for STDERR")
+    parser.add_argument("--progress", type=float, metavar="", default=10.0, help="Seconds between progress records with --telemetry, 0 to disable (default: 10.0)")
+    parser.add_argument("--profile", metavar="", choices=["cprofile", "tracemalloc"], help="Profile the run with cprofile (stats to --profile-out) or tracemalloc (peak and top allocation sites into --telemetry, else --profile-out)")
+    parser.add_argument("--profile-out", metavar="", help="Profile output file path (default: mementomap.prof or mementomap.malloc.json)")
     subparsers = parser.add_subparsers()
 
     generate_parser = subparsers.add_parser("generate", help="Generate a MementoMap from a sorted file with the first columns as SURT (e.g., CDX/CDXJ)")
-    generate_parser.add_argument("infile", help="Input SURT/CDX/CDXJ (plain or GZip) file path or '-' for STDIN")
-    generate_parser.add_argument("outfile", help="Output MementoMap file path")
+    generate_parser.add_argument("infile", help="Input SURT/CDX/CDXJ (plain or compressed) file path, CDX API endpoint URL, or '-' for STDIN")
+    generate_parser.add_argument("outfile", help="Output MementoMap (plain or GZip) file path or '-' for STDOUT")
     generate_parser.add_argument("--hcf", type=float, metavar="", default=float("inf"), help="Host compaction factor (deafault: Inf)")
     generate_parser.add_argument("--pcf", type=float, metavar="", default=float("inf"), help="Path compaction factor (deafault: Inf)")
     generate_parser.add_argument("--ha", type=float, metavar="", default=16.329, help="Power law alpha parameter for host (default: 16.329)")
@@ -80,11 +248,18 @@ def main():
     generate_parser.add_argument("--pk", type=float, metavar="", default=1.429, help="Power law k parameter for path (default: 1.429)")
     generate_parser.add_argument("--hdepth", type=int, metavar="", default=8, help="Max host depth (default: 8)")
     generate_parser.add_argument("--pdepth", type=int, metavar="", default=9, help="Max path depth (default: 9)")
+    generate_parser.add_argument("--bloom", type=float, metavar="", default=0, help="False positive rate of a Bloom filter sidecar (OUTFILE.bloom) to write, 0 to disable (default: 0)")
+    generate_parser.add_argument("--workers", type=int, metavar="", default=1, help="Number of parallel shards for plain file input, or of sorting processes with --sort, 0 for all cores (default: 1)")
+    generate_parser.add_argument("--sort", action="store_true", help="Sort unsorted input with a bounded-memory external sort first")
+    generate_parser.add_argument("--memory", type=int, metavar="", default=1024, help="Memory budget of --sort in MB (default: 1024)")
+    generate_parser.add_argument("--tmpdir", metavar="", help="Directory for --sort spill runs (default: system temporary directory)")
+    generate_parser.add_argument("--concurrency", type=int, metavar="", default=8, help="Number of concurrent page requests to a CDX API endpoint (default: 8)")
+    generate_parser.add_argument("--retries", type=int, metavar="", default=3, help="Number of retries of a failed CDX API page request (default: 3)")
     generate_parser.set_defaults(func=run_generate)
 
     compact_parser = subparsers.add_parser("compact", help="Compact a large MementoMap file into a small one")
-    compact_parser.add_argument("infile", help="Input MementoMap (plain or GZip) file path or '-' for STDIN")
-    compact_parser.add_argument("outfile", help="Output MementoMap file path")
+    compact_parser.add_argument("infile", help="Input MementoMap (plain or compressed) file path or '-' for STDIN")
+    compact_parser.add_argument("outfile", help="Output MementoMap (plain or GZip) file path or '-' for STDOUT")
     compact_parser.add_argument("--hcf", type=float, metavar="", default=1.0, help="Host compaction factor (deafault: 1.0)")
     compact_parser.add_argument("--pcf", type=float, metavar="", default=1.0, help="Path compaction factor (deafault: 1.0)")
     compact_parser.add_argument("--ha", type=float, metavar="", default=16.329, help="Power law alpha parameter for host (default: 16.329)")
@@ -93,23 +268,130 @@ def main():
     compact_parser.add_argument("--pk", type=float, metavar="", default=1.429, help="Power law k parameter for path (default: 1.429)")
     compact_parser.add_argument("--hdepth", type=int, metavar="", default=8, help="Max host depth (default: 8)")
     compact_parser.add_argument("--pdepth", type=int, metavar="", default=9, help="Max path depth (default: 9)")
+    compact_parser.add_argument("--bloom", type=float, metavar="", default=0, help="False positive rate of a Bloom filter sidecar (OUTFILE.bloom) to write, 0 to disable (default: 0)")
+    compact_parser.add_argument("--workers", type=int, metavar="", default=1, help="Number of parallel shards for plain file input, or of sorting processes with --sort, 0 for all cores (default: 1)")
+    compact_parser.add_argument("--sort", action="store_true", help="Sort unsorted input with a bounded-memory external sort first")
+    compact_parser.add_argument("--memory", type=int, metavar="", default=1024, help="Memory budget of --sort in MB (default: 1024)")
+    compact_parser.add_argument("--tmpdir", metavar="", help="Directory for --sort spill runs (default: system temporary directory)")
+    compact_parser.add_argument("--sweep", type=sweep_setting, action="append", metavar="", help="An HCF:PCF setting to compact with, repeat to write one OUTFILE-HCF-PCF file per setting (or OUTFILE with {hcf} and {pcf} placeholders) in a single pass and print a table of their counts")
     compact_parser.set_defaults(func=run_compact)
 
+    merge_parser = subparsers.add_parser("merge", help="Merge multiple sorted MementoMaps into one")
+    merge_parser.add_argument("outfile", help="Output MementoMap (plain or GZip) file path or '-' for STDOUT")
+    merge_parser.add_argument("infiles", nargs="+", help="Input MementoMap (plain or compressed) file paths or '-' for STDIN")
+    merge_parser.add_argument("--compact", action="store_true", help="Compact the merged stream instead of writing it as is")
+    merge_parser.add_argument("--hcf", type=float, metavar="", default=1.0, help="Host compaction factor, with --compact (deafault: 1.0)")
+    merge_parser.add_argument("--pcf", type=float, metavar="", default=1.0, help="Path compaction factor, with --compact (deafault: 1.0)")
+    merge_parser.add_argument("--ha", type=float, metavar="", default=16.329, help="Power law alpha parameter for host (default: 16.329)")
+    merge_parser.add_argument("--pa", type=float, metavar="", default=24.546, help="Power law alpha parameter for path (default: 24.546)")
+    merge_parser.add_argument("--hk", type=float, metavar="", default=0.714, help="Power law k parameter for host (default: 0.714)")
+    merge_parser.add_argument("--pk", type=float, metavar="", default=1.429, help="Power law k parameter for path (default: 1.429)")
+    merge_parser.add_argument("--hdepth", type=int, metavar="", default=8, help="Max host depth (default: 8)")
+    merge_parser.add_argument("--pdepth", type=int, metavar="", default=9, help="Max path depth (default: 9)")
+    merge_parser.set_defaults(func=run_merge)
+
+    fromlogs_parser = subparsers.add_parser("fromlogs", help="Generate a usage based MementoMap from Common Log formatted access logs of Memento URIs")
+    fromlogs_parser.add_argument("outfile", help="Output MementoMap (plain or GZip) file path or '-' for STDOUT")
+    fromlogs_parser.add_argument("infiles", nargs="+", help="Input access log (plain or compressed) file paths or '-' for STDIN")
+    fromlogs_parser.add_argument("--hcf", type=float, metavar="", default=float("inf"), help="Host compaction factor (deafault: Inf)")
+    fromlogs_parser.add_argument("--pcf", type=float, metavar="", default=float("inf"), help="Path compaction factor (deafault: Inf)")
+    fromlogs_parser.add_argument("--ha", type=float, metavar="", default=16.329, help="Power law alpha parameter for host (default: 16.329)")
+    fromlogs_parser.add_argument("--pa", type=float, metavar="", default=24.546, help="Power law alpha parameter for path (default: 24.546)")
+    fromlogs_parser.add_argument("--hk", type=float, metavar="", default=0.714, help="Power law k parameter for host (default: 0.714)")
+    fromlogs_parser.add_argument("--pk", type=float, metavar="", default=1.429, help="Power law k parameter for path (default: 1.429)")
+    fromlogs_parser.add_argument("--hdepth", type=int, metavar="", default=8, help="Max host depth (default: 8)")
+    fromlogs_parser.add_argument("--pdepth", type=int, metavar="", default=9, help="Max path depth (default: 9)")
+    fromlogs_parser.add_argument("--bloom", type=float, metavar="", default=0, help="False positive rate of a Bloom filter sidecar (OUTFILE.bloom) to write, 0 to disable (default: 0)")
+    fromlogs_parser.add_argument("--match-field", dest="field_matches", type=field_match, action="append", metavar="", default=[], help="Skip records whose FIELD~RegExp does not match, e.g., status~^2 or method~^GET$ (can be used multiple times)")
+    fromlogs_parser.add_argument("--origtime-format", metavar="", default=origtime_format, help=f"Original datetime format of logs (default: '{origtime_format.replace('%', '%%')}')")
+    fromlogs_parser.add_argument("--memory", type=int, metavar="", default=1024, help="Memory budget of the URI-R counts in MB before spilling to disk (default: 1024)")
+    fromlogs_parser.add_argument("--tmpdir", metavar="", help="Directory for spilled counts (default: system temporary directory)")
+    fromlogs_parser.add_argument("--workers", type=int, metavar="", default=1, help="Number of log parsing processes, 0 for all cores (default: 1)")
+    fromlogs_parser.set_defaults(func=run_fromlogs)
+
+    update_parser = subparsers.add_parser("update", help="Update a MementoMap with a sorted delta CDX/CDXJ, recompacting only the touched hosts")
+    update_parser.add_argument("mmap", help="Existing MementoMap (plain) file path to update")
+    update_parser.add_argument("infile", help="Input delta SURT/CDX/CDXJ (plain or compressed) file path or '-' for STDIN")
+    update_parser.add_argument("outfile", help="Output MementoMap (plain or GZip) file path or '-' for STDOUT")
+    update_parser.add_argument("--hcf", type=float, metavar="", default=float("inf"), help="Host compaction factor the MementoMap was built with (deafault: Inf)")
+    update_parser.add_argument("--pcf", type=float, metavar="", default=float("inf"), help="Path compaction factor the MementoMap was built with (deafault: Inf)")
+    update_parser.add_argument("--ha", type=float, metavar="", default=16.329, help="Power law alpha parameter for host (default: 16.329)")
+    update_parser.add_argument("--pa", type=float, metavar="", default=24.546, help="Power law alpha parameter for path (default: 24.546)")
+    update_parser.add_argument("--hk", type=float, metavar="", default=0.714, help="Power law k parameter for host (default: 0.714)")
+    update_parser.add_argument("--pk", type=float, metavar="", default=1.429, help="Power law k parameter for path (default: 1.429)")
+    update_parser.add_argument("--hdepth", type=int, metavar="", default=8, help="Max host depth (default: 8)")
+    update_parser.add_argument("--pdepth", type=int, metavar="", default=9, help="Max path depth (default: 9)")
+    update_parser.add_argument("--bloom", type=float, metavar="", default=0, help="False positive rate of a Bloom filter sidecar (OUTFILE.bloom) to write, 0 to disable (default: 0)")
+    update_parser.add_argument("--sort", action="store_true", help="Sort an unsorted delta with a bounded-memory external sort first")
+    update_parser.add_argument("--memory", type=int, metavar="", default=1024, help="Memory budget of --sort in MB (default: 1024)")
+    update_parser.add_argument("--tmpdir", metavar="", help="Directory for --sort spill runs (default: system temporary directory)")
+    update_parser.add_argument("--workers", type=int, metavar="", default=1, help="Number of sorting processes with --sort, 0 for all cores (default: 1)")
+    update_parser.set_defaults(func=run_update)
+
+    convert_parser = subparsers.add_parser("convert", help="Convert a MementoMap between the UKVS text and the compact binary format")
+    convert_parser.add_argument("infile", help="Input MementoMap, binary (plain) or UKVS (plain or compressed), file path or '-' for STDIN")
+    convert_parser.add_argument("outfile", help="Output UKVS (plain or GZip) or binary (plain) file path or '-' for STDOUT")
+    convert_parser.add_argument("--blocksize", type=int, metavar="", default=4, help="Binary block size in KB before compression (default: 4)")
+    convert_parser.add_argument("--codec", metavar="", default="none", choices=list(CODECS), help=f"Binary block compression codec, one of {', '.join(CODECS)} (default: none)")
+    convert_parser.set_defaults(func=run_convert)
+
+    index_parser = subparsers.add_parser("index", help="Build a sparse block index sidecar file (MMAP.idx) for faster lookups")
+    index_parser.add_argument("mmap", help="MementoMap file path to index")
+    index_parser.add_argument("--blocksize", type=int, metavar="", default=64, help="Index block size in KB (default: 64)")
+    index_parser.add_argument("--bloom", type=float, metavar="", default=0, help="Also build a Bloom filter sidecar (MMAP.bloom) with this false positive rate, 0 to skip (default: 0)")
+    index_parser.set_defaults(func=run_index)
+
     lookup_parser = subparsers.add_parser("lookup", help="Look for a SURT into a MementoMap")
     lookup_parser.add_argument("mmap", help="MementoMap file path to look into")
     lookup_parser.add_argument("surt", help="SURT to look for")
+    lookup_parser.add_argument("--cache", type=int, metavar="", default=4096, help="Number of searched keys to cache, 0 to disable (default: 4096)")
     lookup_parser.set_defaults(func=run_lookup)
 
     batchlookup_parser = subparsers.add_parser("batchlookup", help="Look for a list of SURTs into a MementoMap")
     batchlookup_parser.add_argument("mmap", help="MementoMap file path to look into")
-    batchlookup_parser.add_argument("infile", help="Input SURT (plain or GZip) file path or '-' for STDIN")
+    batchlookup_parser.add_argument("infile", help="Input SURT (plain or compressed) file path or '-' for STDIN")
+    batchlookup_parser.add_argument("--cache", type=int, metavar="", default=4096, help="Number of searched keys to cache, 0 to disable (default: 4096)")
+    batchlookup_parser.add_argument("--sorted", action="store_true", help="Stream a sorted input along the MementoMap in a single forward pass")
     batchlookup_parser.set_defaults(func=run_batchlookup)
 
+    route_index_parser = subparsers.add_parser("route-index", help="Combine MementoMaps of many archives into one routing index")
+    route_index_parser.add_argument("outfile", help="Output routing index (plain or GZip) file path or '-' for STDOUT")
+    route_index_parser.add_argument("infiles", nargs="+", help="Input MementoMap (plain or compressed) file paths, optionally as NAME=PATH (default name: file name without extensions)")
+    route_index_parser.set_defaults(func=run_route_index)
+
+    route_parser = subparsers.add_parser("route", help="Look for a SURT into every archive of a routing index")
+    route_parser.add_argument("mmap", help="Routing index file path to look into")
+    route_parser.add_argument("surt", help="SURT to look for")
+    route_parser.add_argument("--cache", type=int, metavar="", default=4096, help="Number of searched keys to cache, 0 to disable (default: 4096)")
+    route_parser.set_defaults(func=run_route)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve lookups into one or more MementoMaps over HTTP")
+    serve_parser.add_argument("mmaps", nargs="+", help="MementoMap file paths to serve, optionally as NAME=PATH (default name: file name without extensions)")
+    serve_parser.add_argument("--host", metavar="", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, metavar="", default=8080, help="Port to listen on (default: 8080)")
+    serve_parser.add_argument("--cache", type=int, metavar="", default=4096, help="Number of searched keys to cache per MementoMap, 0 to disable (default: 4096)")
+    serve_parser.add_argument("--reload", type=float, metavar="", default=2.0, help="Seconds between checks for replaced MementoMap files, 0 to disable (default: 2.0)")
+    serve_parser.set_defaults(func=run_serve)
+
     args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.print_help()
+        parser.exit(2)
+    command = args.func.__name__[4:].replace("_", "-")
+    telemetry = args.telemetry and Telemetry(args.telemetry, args.progress, command)
     try:
-        args.func(**vars(args))
+        with profiled(args.profile, args.profile_out, telemetry):
+            res = args.func(**dict(vars(args), telemetry=telemetry))
+    except KeyboardInterrupt:
+        if telemetry:
+            telemetry.emit("interrupted")
+        parser.exit(130, f"{parser.prog}: interrupted\n")
     except Exception as e:
-        parser.print_help()
+        if telemetry:
+            telemetry.emit("error", error=type(e).__name__, message=str(e))
+        parser.exit(1, f"{parser.prog} {command}: error: {e}\n")
+    if telemetry:
+        telemetry.finish(res)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+import bisect
+import collections
+import lzma
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"\x89MMB\r\n\x1a\n"
+TRAILER = struct.Struct("<QQQ8s")
+RESTART = 16
+CODECS = {"none": 0, "zlib": 1, "lzma": 2, "zstd": 3}
+
+
+def _compress(codec, data):
+    if codec == 1:
+        return zlib.compress(data, 6)
+    if codec == 2:
+        return lzma.compress(data)
+    if codec == 3:
+        return zstandard.ZstdCompressor().compress(data)
+    return bytes(data)
+
+
+def _decompress(codec, data):
+    if codec == 1:
+        return zlib.decompress(data)
+    if codec == 2:
+        return lzma.decompress(data)
+    if codec == 3:
+        if not zstandard:
+            raise ValueError("Reading zstd compressed blocks requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _value(token):
+    if token.isdigit() and (token[:1] != b"0" or token == b"0"):
+        return _varint(int(token) << 1)
+    return _varint(len(token) << 1 | 1) + token
+
+
+def is_binary(mmapfile):
+    with open(mmapfile, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_binary(infiter, opf, blocksize=4096, codec="none"):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, use one of {', '.join(CODECS)}")
+    codec = CODECS[codec]
+    if codec == 3 and not zstandard:
+        raise ValueError("The zstd codec requires the zstandard package")
+    counts = {"inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "blocks": 0}
+    headers = bytearray()
+    directory = bytearray()
+    block = bytearray()
+    restarts = []
+    first = prev = None
+    opf.write(MAGIC)
+    pos = len(MAGIC)
+
+    def flush():
+        block.extend(struct.pack(f"<{len(restarts)}I", *restarts) + struct.pack("<I", len(restarts)))
+        restarts.clear()
+        stored, cid = _compress(codec, block), codec
+        if cid and len(stored) >= len(block):
+            stored, cid = bytes(block), 0
+        opf.write(stored)
+        directory.extend(_varint(len(first)) + first + _varint(pos) + _varint(len(stored)) + bytes([cid]))
+        counts["blocks"] += 1
+        block.clear()
+        return pos + len(stored)
+
+    for line in infiter:
+        counts["inlines"] += 1
+        counts["inbytes"] += len(line)
+        if line[:1] == b"!":
+            headers += line.rstrip(b"\r\n") + b"\n"
+            continue
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            continue
+        key, value = parts[0], parts[1]
+        if not block:
+            first = key
+            n = 0
+        if n % RESTART:
+            shared = len(os.path.commonprefix([prev, key]))
+        else:
+            restarts.append(len(block))
+            shared = 0
+        n += 1
+        block += _varint(shared) + _varint(len(key) - shared) + key[shared:] + _value(value)
+        prev = key
+        counts["outlines"] += 1
+        if len(block) >= blocksize:
+            pos = flush()
+    if block:
+        pos = flush()
+    opf.write(directory)
+    opf.write(headers)
+    opf.write(TRAILER.pack(pos, pos + len(directory), counts["blocks"], MAGIC))
+    counts["outbytes"] = pos + len(directory) + len(headers) + TRAILER.size
+    counts["outlines"] += headers.count(b"\n")
+    return counts
+
+
+class BinaryMap:
+    def __init__(self, buf, cache_size=64):
+        if len(buf) < len(MAGIC) + TRAILER.size or buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a binary MementoMap")
+        diroff, headoff, nblocks, magic = TRAILER.unpack(buf[-TRAILER.size:])
+        if magic != MAGIC:
+            raise ValueError("Truncated binary MementoMap")
+        self.buf = buf
+        self.headers = bytes(buf[headoff:len(buf)-TRAILER.size]).splitlines(True)
+        self.keys, self.blocks = [], []
+        directory = buf[diroff:headoff]
+        pos = 0
+        for _ in range(nblocks):
+            n, pos = _read_varint(directory, pos)
+            self.keys.append(directory[pos:pos+n])
+            offset, pos = _read_varint(directory, pos + n)
+            length, pos = _read_varint(directory, pos)
+            self.blocks.append((offset, length, directory[pos]))
+            pos += 1
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def block(self, i):
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        offset, length, codec = self.blocks[i]
+        data = _decompress(codec, self.buf[offset:offset+length])
+        n = struct.unpack_from("<I", data, len(data) - 4)[0]
+        end = len(data) - 4 - 4 * n
+        res = self.cache[i] = (data, struct.unpack_from(f"<{n}I", data, end) + (end,))
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return res
+
+    def _scan(self, data, pos, end):
+        key = b""
+        while pos < end:
+            shared, pos = _read_varint(data, pos)
+            n, pos = _read_varint(data, pos)
+            key = key[:shared] + data[pos:pos+n]
+            v, pos = _read_varint(data, pos + n)
+            if v & 1:
+                n = v >> 1
+                yield key, data[pos:pos+n]
+                pos += n
+            else:
+                yield key, b"%d" % (v >> 1)
+
+    def search(self, key):
+        i = bisect.bisect_right(self.keys, key) - 1
+        if i < 0:
+            return
+        data, restarts = self.block(i)
+        lo, hi = 1, len(restarts) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            n, pos = _read_varint(data, restarts[mid] + 1)
+            if data[pos:pos+n] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for k, value in self._scan(data, restarts[lo-1], restarts[lo]):
+            if k >= key:
+                return [k, value] if k == key else None
+
+    def entries(self):
+        for i in range(len(self.blocks)):
+            data, restarts = self.block(i)
+            yield from self._scan(data, 0, restarts[-1])
+
+    def lines(self):
+        yield from self.headers
+        for key, value in self.entries():
+            yield key + b" " + value + b"\n"
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import ssl
+import time
+import zlib
+
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from mementomap import __VERSION__
+from mementomap.queued import QueuedReader
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def is_remote(infile):
+    return infile.startswith(("http://", "https://"))
+
+
+class CDXAPIReader(QueuedReader):
+    def __init__(self, endpoint, concurrency=8, retries=3, timeout=60.0, queue_size=16):
+        url = urlsplit(endpoint)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.netloc = url.netloc.rpartition("@")[2]
+        self.path = url.path or "/"
+        self.params = [(k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k not in ["page", "showNumPages"]]
+        if not any(k == "fl" for k, v in self.params):
+            self.params.append(("fl", "urlkey"))
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.timeout = timeout
+        super().__init__({"inbytes": 0, "outbytes": 0, "pages": 0, "requests": 0, "retries": 0, "connections": 0, "decode_seconds": 0.0}, queue_size)
+
+    def _target(self, **params):
+        return f"{self.path}?{urlencode(self.params + list(params.items()))}"
+
+    async def _connect(self):
+        self.counts["connections"] += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    while (await reader.readline()).strip():
+                        pass
+                    return bytes(body)
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        if "content-length" in headers:
+            return await reader.readexactly(int(headers["content-length"]))
+        return await reader.read()
+
+    async def _request(self, conn, target):
+        reader, writer = conn
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {self.netloc}\r\nUser-Agent: mementomap/{__VERSION__}\r\nAccept-Encoding: gzip\r\nConnection: keep-alive\r\n\r\n".encode())
+        await writer.drain()
+        status = await reader.readline()
+        if not status:
+            raise ConnectionResetError("Connection closed by the CDX server")
+        version, code = status.decode("latin-1").split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await self._read_body(reader, headers)
+        self.counts["inbytes"] += len(body)
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 31)
+        keepalive = headers.get("connection", "").lower() != "close" if version == "HTTP/1.1" else headers.get("connection", "").lower() == "keep-alive"
+        return int(code), body, keepalive
+
+    async def _fetch(self, pool, target):
+        for attempt in range(self.retries + 1):
+            conn = await pool.get()
+            try:
+                if not conn:
+                    conn = await self._connect()
+                self.counts["requests"] += 1
+                status, body, keepalive = await asyncio.wait_for(self._request(conn, target), self.timeout)
+            except (OSError, EOFError, ValueError, zlib.error, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if conn:
+                    conn[1].close()
+                pool.put_nowait(None)
+                if attempt == self.retries:
+                    raise ConnectionError(f"Fetching {self.netloc}{target} failed after {attempt + 1} attempts: {e!r}")
+            else:
+                if not keepalive:
+                    conn[1].close()
+                    conn = None
+                pool.put_nowait(conn)
+                if status == 200:
+                    return body
+                if status not in RETRY_STATUS or attempt == self.retries:
+                    raise ConnectionError(f"Fetching {self.netloc}{target} failed with status {status}")
+            self.counts["retries"] += 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def _pages(self, pool):
+        body = await self._fetch(pool, self._target(showNumPages="true"))
+        try:
+            res = json.loads(body)
+            return res["pages"] if isinstance(res, dict) else int(res), None
+        except (ValueError, KeyError, TypeError) as e:
+            return 1, body
+
+    async def _emit(self, loop, body):
+        if body and not body.endswith(b"\n"):
+            body += b"\n"
+        self.counts["pages"] += 1
+        self.counts["outbytes"] += len(body)
+        await loop.run_in_executor(None, self._put, body)
+
+    async def _run(self, loop):
+        pool = asyncio.Queue()
+        for _ in range(self.concurrency):
+            pool.put_nowait(None)
+        pages, body = await self._pages(pool)
+        if body is not None:
+            await self._emit(loop, body)
+            return
+        pending = []
+        try:
+            for page in range(pages):
+                pending.append(loop.create_task(self._fetch(pool, self._target(page=page))))
+                if len(pending) < 2 * self.concurrency:
+                    continue
+                await self._emit(loop, await pending.pop(0))
+                if self.stopped.is_set():
+                    return
+            while pending and not self.stopped.is_set():
+                await self._emit(loop, await pending.pop(0))
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            while not pool.empty():
+                conn = pool.get_nowait()
+                if conn:
+                    conn[1].close()
+
+    def _produce(self):
+        t = time.perf_counter()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run(loop))
+        except Exception as e:
+            self._put(e)
+        finally:
+            loop.close()
+        self.counts["decode_seconds"] = time.perf_counter() - t
+        self._put(None)
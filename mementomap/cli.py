@@ -1,107 +1,494 @@
+import bisect
+import collections
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import locale
+import math
+import mmap
+import os
 import re
+import shutil
+import sys
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mementomap.binary import MAGIC, BinaryMap, is_binary, write_binary
+from mementomap.commonlog import log_keys, origtime_format
+from mementomap.inputs import open_input
 
 locale.setlocale(locale.LC_ALL, 'C')
 
+keyre = re.compile(rb"(.+)([,/]).+")
+ENTRY_BYTES = 160
 
-def compact(infiter, outfile, hcf=1.0, pcf=1.0, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, **kw):
-    sep = {"host": b",", "path": b"/"}
-    maxdepth = {"host": hdepth, "path": pdepth}
-    cutoff = {
-        "host": [ha * (i+1) ** -hk * hcf for i in range(maxdepth["host"])],
-        "path": [pa * (i+1) ** -pk * pcf for i in range(maxdepth["path"])]
-    }
-    trail = {
-        "host": [None]*maxdepth["host"],
-        "path": [None]*maxdepth["path"]
-    }
-    counts = {"inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "rollups": 0}
 
-    def _gen_keys(str, layer):
-        parts = str.strip(sep[layer]).split(sep[layer], maxdepth[layer]-1)
-        return [sep[layer].join(parts[:i+1]) for i in range(len(parts))]
-
-    def _init_node(layer, idx):
-        trail[layer][idx] = {
-            "key": keys[layer][idx],
-            "ccount": 0,
-            "mcount": freq,
-            "optr": opf.tell(),
-            "oline": counts["outlines"]
-        }
-        if idx:
-            trail[layer][idx-1]["ccount"] += 1
-
-    def _reset_trail(layer, idx):
-        for i in range(idx, maxdepth[layer]):
-            if not trail[layer][i]:
-                break
-            trail[layer][i] = None
+def _open_output(outfile):
+    if hasattr(outfile, "write"):
+        return outfile, False
+    if outfile == "-":
+        return sys.stdout.buffer, False
+    if outfile.endswith(".gz"):
+        return gzip.open(outfile, "wb"), True
+    return open(outfile, "wb"), True
 
-    def _compact_subtree(layer, idx):
-        compacted = False
-        for i in range(idx, maxdepth[layer]):
-            if not trail[layer][i]:
-                break
-            if not i and layer == "host":
-                continue
-            if trail[layer][i]["ccount"] > cutoff[layer][i]:
-                opf.seek(trail[layer][i]["optr"])
-                counts["outlines"] = trail[layer][i]["oline"]
-                opf.write(trail[layer][i]["key"] + sep[layer] + b"* %d\n" % trail[layer][i]["mcount"])
-                counts["outlines"] += 1
-                counts["rollups"] += 1
-                compacted = True
-                break
-        _reset_trail(layer, idx)
-        if layer == "host":
-            if compacted:
-                _reset_trail("path", 0)
-            else:
-                _compact_subtree("path", 0)
 
-    opf = open(outfile, "wb")
-    for line in infiter:
-        counts["inlines"] += 1
-        counts["inbytes"] += len(line)
-        if line[0] == b"!":
-            opf.write(line)
-            counts["outlines"] += 1
-            continue
-        try:
-            parts = line.split(maxsplit=2)
-            surtk = parts[0].split(b"?")[0].strip(b"/,")
-            freq = int(parts[1])
-        except Exception as e:
-            continue
-        if b"," not in surtk:
-            continue
-        host, _, path = surtk.partition(b")")
-        keys = {
-            "host": _gen_keys(host, "host"),
-            "path": _gen_keys(surtk, "path")
-        }
-
-        for layer in ["host", "path"]:
-            for i in range(len(keys[layer])):
-                if not trail[layer][i]:
-                    _init_node(layer, i)
-                elif trail[layer][i]["key"] == keys[layer][i]:
-                    trail[layer][i]["mcount"] += freq
+class RollupWriter:
+    def __init__(self, outfile, bufsize=64 << 20):
+        self.opf, self.owned = _open_output(outfile)
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.base = 0
+        self.spill = None
+        self.spilled = 0
+
+    def tell(self):
+        return self.base + self.spilled + len(self.buf)
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) > self.bufsize:
+            self.spill_buffer()
+
+    def spill_buffer(self):
+        if not self.spill:
+            self.spill = tempfile.TemporaryFile()
+        self.spill.seek(self.spilled)
+        self.spill.write(self.buf)
+        self.spilled += len(self.buf)
+        self.buf.clear()
+
+    def seek(self, pos):
+        pos -= self.base
+        if pos < 0:
+            raise ValueError("Cannot seek back into already flushed output")
+        if pos >= self.spilled:
+            del self.buf[pos-self.spilled:]
+        else:
+            self.spill.truncate(pos)
+            self.spilled = pos
+            self.buf.clear()
+
+    def flush(self, pos=None):
+        size = (self.tell() if pos is None else pos) - self.base
+        if self.spilled:
+            if size < self.spilled:
+                return
+            self.spill.seek(0)
+            shutil.copyfileobj(self.spill, self.opf, 1 << 20)
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.base += self.spilled
+            size -= self.spilled
+            self.spilled = 0
+        if size:
+            self.opf.write(self.buf[:size])
+            del self.buf[:size]
+            self.base += size
+
+    def close(self):
+        self.flush()
+        if self.spill:
+            self.spill.close()
+        if self.owned:
+            self.opf.close()
+        else:
+            self.opf.flush()
+        return self.base
+
+
+def _batches(infiter, size=1 << 20):
+    if not hasattr(infiter, "read"):
+        yield infiter, b""
+        return
+    rest = b""
+    while True:
+        chunk = infiter.read(size)
+        if not chunk:
+            break
+        lines = chunk.split(b"\n")
+        lines[0] = rest + lines[0]
+        rest = lines.pop()
+        yield lines, b"\n"
+    if rest:
+        yield [rest], b""
+
+
+class Trails:
+    __slots__ = ["hkey", "hcc", "hbase", "hd", "pkey", "pcc", "pbase", "pd", "total", "cdx", "group", "gcount", "inlines", "inbytes", "telemetry"]
+
+    def __init__(self, hdepth=8, pdepth=9, cdx=False, telemetry=None):
+        self.hkey, self.hcc, self.hbase = [[None]*hdepth for _ in range(3)]
+        self.pkey, self.pcc, self.pbase = [[None]*pdepth for _ in range(3)]
+        self.hd = self.pd = self.total = 0
+        self.cdx = cdx
+        self.group = None
+        self.gcount = 0
+        self.inlines = self.inbytes = 0
+        self.telemetry = telemetry
+
+    def steps(self, infiter):
+        # Yields (surtk, freq, hi, hn, hd, pi, pn, pd, total) for each entry before the trails move past it,
+        # hi and pi being the matched host and path depths, or (line, None, ...) for header lines
+        hkey, hcc, hbase, pkey, pcc, pbase = self.hkey, self.hcc, self.hbase, self.pkey, self.pcc, self.pbase
+        hdepth, pdepth = len(hkey), len(pkey)
+        hd, pd, total = self.hd, self.pd, self.total
+        cdx, group, gcount = self.cdx, self.group, self.gcount
+        inlines, inbytes, telemetry = self.inlines, self.inbytes, self.telemetry
+        for lines, nl in _batches(infiter):
+            if telemetry and nl:
+                telemetry.lines, telemetry.position = inlines, lines[0]
+            if nl and not cdx:
+                inbytes += len(lines)
+            for line in lines:
+                if cdx:
+                    if line is None:
+                        surtk = None
+                    else:
+                        parts = line.split(None, 1)
+                        if not parts:
+                            continue
+                        surtk = parts[0]
+                        q = surtk.find(b"?")
+                        if q >= 0:
+                            surtk = surtk[:q]
+                        surtk = surtk.strip(b"/,")
+                        if b")" not in surtk:
+                            surtk = None
+                    if surtk == group:
+                        gcount += 1
+                        continue
+                    surtk, freq, group, gcount = group, gcount, surtk, 1
+                    if not surtk:
+                        continue
+                    inlines += 1
+                    inbytes += len(surtk) + len(str(freq)) + 1
+                    if surtk[:1] == b"!":
+                        yield b"%s %d\n" % (surtk, freq), None, 0, 0, 0, 0, 0, 0, 0
+                        continue
                 else:
-                    _compact_subtree(layer, i)
-                    _init_node(layer, i)
+                    inlines += 1
+                    inbytes += len(line)
+                    if line[:1] == b"!":
+                        yield line + nl, None, 0, 0, 0, 0, 0, 0, 0
+                        continue
+                    parts = line.split(None, 2)
+                    if len(parts) < 2:
+                        continue
+                    try:
+                        freq = int(parts[1])
+                    except ValueError:
+                        continue
+                    surtk = parts[0]
+                    q = surtk.find(b"?")
+                    if q >= 0:
+                        surtk = surtk[:q]
+                    surtk = surtk.strip(b"/,")
+                if b"," not in surtk:
+                    continue
+                slen = len(surtk)
+                hlen = surtk.find(b")")
+                if hlen < 0:
+                    hlen = slen
+                while hlen and surtk[hlen-1] == 44:
+                    hlen -= 1
+                hn = surtk.count(b",", 0, hlen) + 1
+                if hn > hdepth:
+                    hn = hdepth
+                pn = surtk.count(b"/") + 1
+                if pn > pdepth:
+                    pn = pdepth
 
-        opf.write(surtk + b" %d\n" % freq)
-        counts["outlines"] += 1
-    _compact_subtree("host", 0)
-    _compact_subtree("path", 0)
-    opf.truncate()
-    counts["outbytes"] += opf.tell()
-    opf.close()
+                hi = hd if hd < hn else hn
+                while hi:
+                    k = hkey[hi-1]
+                    e = len(k)
+                    if surtk.startswith(k) and (e == hlen if hi == hn else e < hlen and surtk[e] == 44):
+                        break
+                    hi -= 1
+                # A new host starts a new path trail
+                pi = 0 if hi < hn and hi < hd else pd if pd < pn else pn
+                while pi:
+                    k = pkey[pi-1]
+                    e = len(k)
+                    if surtk.startswith(k) and (e == slen if pi == pn else e < slen and surtk[e] == 47):
+                        break
+                    pi -= 1
+
+                yield surtk, freq, hi, hn, hd, pi, pn, pd, total
+
+                if hi < hn:
+                    if hi < hd:
+                        pd = 0
+                    pos = len(hkey[hi-1]) + 1 if hi else 0
+                    for j in range(hi, hn):
+                        e = hlen if j == hn - 1 else surtk.find(b",", pos, hlen)
+                        hkey[j] = surtk[:e]
+                        hcc[j] = 0
+                        hbase[j] = total
+                        if j:
+                            hcc[j-1] += 1
+                        pos = e + 1
+                    hd = hn
+                elif hi < hd:
+                    for j in range(hi, hd):
+                        hbase[j] += freq
+                if pi < pn:
+                    pos = len(pkey[pi-1]) + 1 if pi else 0
+                    for j in range(pi, pn):
+                        e = slen if j == pn - 1 else surtk.find(b"/", pos)
+                        pkey[j] = surtk[:e]
+                        pcc[j] = 0
+                        pbase[j] = total
+                        if j:
+                            pcc[j-1] += 1
+                        pos = e + 1
+                    pd = pn
+                elif pi < pd:
+                    for j in range(pi, pd):
+                        pbase[j] += freq
+                total += freq
+        self.hd, self.pd, self.total = hd, pd, total
+        self.group, self.gcount = group, gcount
+        self.inlines, self.inbytes = inlines, inbytes
+
+
+class Compactor(Trails):
+    __slots__ = ["hcut", "pcut", "hptr", "hline", "pptr", "pline", "opf", "counts", "hrollups", "prollups"]
+
+    def __init__(self, outfile, hcf=1.0, pcf=1.0, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, cdx=False, telemetry=None, **kw):
+        super().__init__(hdepth, pdepth, cdx, telemetry)
+        self.hcut = [ha * (i+1) ** -hk * hcf for i in range(hdepth)]
+        self.pcut = [pa * (i+1) ** -pk * pcf for i in range(pdepth)]
+        self.hptr, self.hline = [[None]*hdepth for _ in range(2)]
+        self.pptr, self.pline = [[None]*pdepth for _ in range(2)]
+        self.opf = RollupWriter(outfile)
+        self.counts = {"inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "rollups": 0}
+        self.hrollups = [0] * hdepth
+        self.prollups = [0] * pdepth
+        if telemetry:
+            self.opf.opf = telemetry.wrap_output(self.opf.opf)
+
+    def feed(self, infiter):
+        hcut, hkey, hcc, hbase, hptr, hline = self.hcut, self.hkey, self.hcc, self.hbase, self.hptr, self.hline
+        pcut, pkey, pcc, pbase, pptr, pline = self.pcut, self.pkey, self.pcc, self.pbase, self.pptr, self.pline
+        opf = self.opf
+        buf, bufsize, write, seek = opf.buf, opf.bufsize, opf.write, opf.seek
+        off = flushed = opf.base + opf.spilled
+        counts = self.counts
+        outlines, rollups = counts["outlines"], counts["rollups"]
+        hrollups, prollups = self.hrollups, self.prollups
+        for surtk, freq, hi, hn, hd, pi, pn, pd, total in self.steps(infiter):
+            if freq is None:
+                buf += surtk
+                outlines += 1
+                continue
+            if hi < hn:
+                if hi < hd:
+                    rolled = False
+                    for j in range(hi or 1, hd):
+                        if hcc[j] > hcut[j]:
+                            seek(hptr[j])
+                            outlines = hline[j] + 1
+                            rollups += 1
+                            hrollups[j] += 1
+                            write(hkey[j] + b",* %d\n" % (total - hbase[j]))
+                            rolled = True
+                            break
+                    if not rolled:
+                        for j in range(pd):
+                            if pcc[j] > pcut[j]:
+                                seek(pptr[j])
+                                outlines = pline[j] + 1
+                                rollups += 1
+                                prollups[j] += 1
+                                write(pkey[j] + b"/* %d\n" % (total - pbase[j]))
+                                break
+                    off = opf.base + opf.spilled
+                    pd = 0
+                ptr = off + len(buf)
+                for j in range(hi, hn):
+                    hptr[j] = ptr
+                    hline[j] = outlines
+                hd = hn
+            if pi < pn:
+                for j in range(pi, pd):
+                    if pcc[j] > pcut[j]:
+                        seek(pptr[j])
+                        outlines = pline[j] + 1
+                        rollups += 1
+                        prollups[j] += 1
+                        write(pkey[j] + b"/* %d\n" % (total - pbase[j]))
+                        off = opf.base + opf.spilled
+                        break
+                ptr = off + len(buf)
+                for j in range(pi, pn):
+                    pptr[j] = ptr
+                    pline[j] = outlines
+
+            buf += b"%s %d\n" % (surtk, freq)
+            outlines += 1
+            if len(buf) > bufsize:
+                opf.spill_buffer()
+                off = opf.base + opf.spilled
+            ptr = hptr[1] if hd > 1 and hptr[1] < pptr[0] else pptr[0]
+            if ptr - flushed >= 1 << 20:
+                opf.flush(ptr)
+                off = flushed = opf.base + opf.spilled
+        counts["inlines"], counts["inbytes"], counts["outlines"], counts["rollups"] = self.inlines, self.inbytes, outlines, rollups
+
+    def _rollup(self, cut, key, cc, base, ptr, line, depth, start, sep, hist):
+        for i in range(start, depth):
+            if cc[i] > cut[i]:
+                self.opf.seek(ptr[i])
+                self.counts["outlines"] = line[i] + 1
+                self.counts["rollups"] += 1
+                hist[i] += 1
+                self.opf.write(key[i] + sep + b"* %d\n" % (self.total - base[i]))
+                return True
+        return False
+
+    def close(self):
+        if self.cdx:
+            self.feed([None])
+        if not self._rollup(self.hcut, self.hkey, self.hcc, self.hbase, self.hptr, self.hline, self.hd, 1, b",", self.hrollups):
+            self._rollup(self.pcut, self.pkey, self.pcc, self.pbase, self.pptr, self.pline, self.pd, 0, b"/", self.prollups)
+        self.hd = self.pd = 0
+        self.counts["outbytes"] += self.opf.close()
+        return self.counts
+
+
+def _depths(hist):
+    return {str(i + 1): n for i, n in enumerate(hist) if n}
+
+
+def compact(infiter, outfile, hcf=1.0, pcf=1.0, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, cdx=False, bloom=None, telemetry=None, **kw):
+    engine = Compactor(outfile, hcf, pcf, ha, hk, pa, pk, hdepth, pdepth, cdx, telemetry)
+    engine.feed(infiter if not telemetry or hasattr(infiter, "read") else telemetry.meter(infiter))
+    counts = engine.close()
+    if telemetry:
+        telemetry.record(rollup_depths={"host": _depths(engine.hrollups), "path": _depths(engine.prollups)})
+    if bloom:
+        _output_bloom(outfile, bloom, counts)
     return counts
 
 
+class SweepCompactor(Trails):
+    def __init__(self, outfiles, settings, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, **kw):
+        if len(outfiles) != len(settings):
+            raise ValueError("Need one output per (hcf, pcf) setting")
+        super().__init__(hdepth, pdepth)
+        self.hcut = [[ha * (i+1) ** -hk * hcf for i in range(hdepth)] for hcf, pcf in settings]
+        self.pcut = [[pa * (i+1) ** -pk * pcf for i in range(pdepth)] for hcf, pcf in settings]
+        self.hmin = [min(cut) for cut in zip(*self.hcut)]
+        self.pmin = [min(cut) for cut in zip(*self.pcut)]
+        self.hptr, self.hline = [[[None]*hdepth for _ in settings] for _ in range(2)]
+        self.pptr, self.pline = [[[None]*pdepth for _ in settings] for _ in range(2)]
+        self.opfs = [RollupWriter(outfile) for outfile in outfiles]
+        self.outlines = [0] * len(settings)
+        self.rollups = [0] * len(settings)
+        self.counts = [{"hcf": hcf, "pcf": pcf, "inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "rollups": 0} for hcf, pcf in settings]
+
+    def _rollup(self, s, ptr, line, entry):
+        self.opfs[s].seek(ptr)
+        self.outlines[s] = line + 1
+        self.rollups[s] += 1
+        self.opfs[s].write(entry)
+
+    def feed(self, infiter):
+        hkey, hcc, hbase, pkey, pcc, pbase = self.hkey, self.hcc, self.hbase, self.pkey, self.pcc, self.pbase
+        hcut, pcut, hptr, hline, pptr, pline = self.hcut, self.pcut, self.hptr, self.hline, self.pptr, self.pline
+        hmin, pmin = self.hmin, self.pmin
+        opfs, outlines = self.opfs, self.outlines
+        bufs = [opf.buf for opf in opfs]
+        settings = range(len(opfs))
+        flushed = [opf.base + opf.spilled for opf in opfs]
+        n = 0
+        for surtk, freq, hi, hn, hd, pi, pn, pd, total in self.steps(infiter):
+            if freq is None:
+                for s in settings:
+                    bufs[s] += surtk
+                    outlines[s] += 1
+                continue
+            if hi < hn:
+                if hi < hd:
+                    if any(hcc[j] > hmin[j] for j in range(hi or 1, hd)) or any(pcc[j] > pmin[j] for j in range(pd)):
+                        for s in settings:
+                            j = next((j for j in range(hi or 1, hd) if hcc[j] > hcut[s][j]), None)
+                            if j is not None:
+                                self._rollup(s, hptr[s][j], hline[s][j], hkey[j] + b",* %d\n" % (total - hbase[j]))
+                                continue
+                            j = next((j for j in range(pd) if pcc[j] > pcut[s][j]), None)
+                            if j is not None:
+                                self._rollup(s, pptr[s][j], pline[s][j], pkey[j] + b"/* %d\n" % (total - pbase[j]))
+                    pd = 0
+                for s in settings:
+                    ptr, line = opfs[s].tell(), outlines[s]
+                    for j in range(hi, hn):
+                        hptr[s][j] = ptr
+                        hline[s][j] = line
+                hd = hn
+            if pi < pn:
+                if any(pcc[j] > pmin[j] for j in range(pi, pd)):
+                    for s in settings:
+                        j = next((j for j in range(pi, pd) if pcc[j] > pcut[s][j]), None)
+                        if j is not None:
+                            self._rollup(s, pptr[s][j], pline[s][j], pkey[j] + b"/* %d\n" % (total - pbase[j]))
+                for s in settings:
+                    ptr, line = opfs[s].tell(), outlines[s]
+                    for j in range(pi, pn):
+                        pptr[s][j] = ptr
+                        pline[s][j] = line
+
+            entry = b"%s %d\n" % (surtk, freq)
+            for s in settings:
+                bufs[s] += entry
+                outlines[s] += 1
+            n += 1
+            if n & 1023:
+                continue
+            for s in settings:
+                opf = opfs[s]
+                if len(bufs[s]) > opf.bufsize:
+                    opf.spill_buffer()
+                ptr = hptr[s][1] if hd > 1 and hptr[s][1] < pptr[s][0] else pptr[s][0]
+                if ptr - flushed[s] >= 1 << 20:
+                    opf.flush(ptr)
+                    flushed[s] = opf.base + opf.spilled
+        for res in self.counts:
+            res["inlines"], res["inbytes"] = self.inlines, self.inbytes
+
+    def close(self):
+        hd, pd, total = self.hd, self.pd, self.total
+        for s, opf in enumerate(self.opfs):
+            j = next((j for j in range(1, hd) if self.hcc[j] > self.hcut[s][j]), None)
+            if j is not None:
+                self._rollup(s, self.hptr[s][j], self.hline[s][j], self.hkey[j] + b",* %d\n" % (total - self.hbase[j]))
+            else:
+                j = next((j for j in range(pd) if self.pcc[j] > self.pcut[s][j]), None)
+                if j is not None:
+                    self._rollup(s, self.pptr[s][j], self.pline[s][j], self.pkey[j] + b"/* %d\n" % (total - self.pbase[j]))
+            self.counts[s]["outbytes"] += opf.close()
+            self.counts[s]["outlines"] = self.outlines[s]
+            self.counts[s]["rollups"] = self.rollups[s]
+        self.hd = self.pd = 0
+        return self.counts
+
+
+def sweep(infiter, outfiles, settings, ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, bloom=None, **kw):
+    engine = SweepCompactor(outfiles, settings, ha, hk, pa, pk, hdepth, pdepth)
+    engine.feed(infiter)
+    table = engine.close()
+    if bloom:
+        for outfile, counts in zip(outfiles, table):
+            _output_bloom(outfile, bloom, counts)
+    return table
+
+
 def cdx2hxpx(infiter):
     key = None
     count = 0
@@ -124,12 +511,317 @@ def cdx2hxpx(infiter):
 
 
 def generate(infiter, outfile, hcf=float("inf"), pcf=float("inf"), **kw):
-    hxpx = cdx2hxpx(infiter)
-    return compact(hxpx, outfile, hcf, pcf, **kw)
+    return compact(infiter, outfile, hcf, pcf, cdx=True, **kw)
+
+
+def fromlogs(infiter, outfile, hcf=float("inf"), pcf=float("inf"), field_matches=[], origtime_format=origtime_format, memory=1 << 30, workers=1, tmpdir=None, **kw):
+    keys = functools.partial(log_keys, field_matches=field_matches, origtime_format=origtime_format)
+    return compact(sort_keys(infiter, cdx=True, memory=memory, workers=workers, tmpdir=tmpdir, keys=keys), outfile, hcf, pcf, **kw)
+
+
+def _chunks(infiter, size):
+    if hasattr(infiter, "read"):
+        while True:
+            data = infiter.read(size)
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += infiter.readline()
+            yield data
+        return
+    batch = []
+    used = 0
+    for line in infiter:
+        batch.append(line if line.endswith(b"\n") else line + b"\n")
+        used += len(line)
+        if used >= size:
+            yield b"".join(batch)
+            batch = []
+            used = 0
+    if batch:
+        yield b"".join(batch)
+
+
+def _aggregate(chunk, cdx=False, keys=None, limit=None, headers=None, spill=None):
+    # Hand the counts to spill and start over whenever their estimated size reaches limit
+    agg = {}
+    size = 0
+    for line in keys(chunk) if keys else io.BytesIO(chunk):
+        if cdx:
+            parts = line.split(None, 1)
+            if not parts:
+                continue
+            surtk = parts[0]
+            freq = 1
+        else:
+            if line[:1] == b"!":
+                line = line.rstrip(b"\r\n") + b"\n"
+                if headers is not None and line not in headers:
+                    headers.append(line)
+                continue
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                continue
+            try:
+                freq = int(parts[1])
+            except ValueError:
+                continue
+            surtk = parts[0]
+        q = surtk.find(b"?")
+        if q >= 0:
+            surtk = surtk[:q]
+        surtk = surtk.strip(b"/,")
+        if cdx and b")" not in surtk:
+            continue
+        if surtk in agg:
+            agg[surtk] += freq
+            continue
+        agg[surtk] = freq
+        size += len(surtk) + ENTRY_BYTES
+        if limit and size >= limit:
+            spill(agg)
+            agg = {}
+            size = 0
+    return agg
+
+
+def _sorted_items(agg):
+    for surtk in sorted(agg):
+        yield surtk, agg[surtk]
+
+
+def _write_run(items, tmpdir=None):
+    fd, path = tempfile.mkstemp(prefix=".mmsort-", dir=tmpdir)
+    with os.fdopen(fd, "wb") as f:
+        f.writelines(b"%s %d\n" % kv for kv in items)
+    return path
+
+
+def _sort_chunk(chunk, cdx=False, tmpdir=None, keys=None, limit=None):
+    headers = []
+    runs = []
+    spill = lambda agg: runs.append(_write_run(_sorted_items(agg), tmpdir))
+    agg = _aggregate(chunk, cdx, keys, limit, headers, spill)
+    if agg:
+        spill(agg)
+    return runs, headers
+
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        for line in f:
+            surtk, _, freq = line.rpartition(b" ")
+            yield surtk, int(freq)
+
+
+def _sum_runs(runs):
+    key = None
+    total = 0
+    for surtk, freq in heapq.merge(*[_read_run(path) for path in runs]):
+        if surtk != key:
+            if key is not None:
+                yield key, total
+            key = surtk
+            total = 0
+        total += freq
+    if key is not None:
+        yield key, total
+
+
+def merge_runs(runs, tmpdir=None, fanin=256, fmt=b"%s %d\n"):
+    while len(runs) > fanin:
+        group = runs[:fanin]
+        path = _write_run(_sum_runs(group), tmpdir)
+        del runs[:fanin]
+        runs.append(path)
+        for run in group:
+            os.remove(run)
+    for kv in _sum_runs(runs):
+        yield fmt % kv
+
+
+def sort_keys(infiter, cdx=False, memory=1 << 30, workers=1, tmpdir=None, fanin=256, keys=None):
+    # Each worker gets memory / workers: half for its counts, the rest for its raw chunk and the copies of it being read or in transit
+    workers = workers or os.cpu_count() or 1
+    # Like cdx2hxpx, CDX keys come out without a newline, so compact counts the same input bytes as generate
+    fmt = b"%s %d" if cdx else b"%s %d\n"
+    share = memory // workers
+    limit = max(share // 2, 1 << 20)
+    chunks = _chunks(infiter, max(share // 8, 1 << 20))
+    first = next(chunks, b"")
+    second = next(chunks, None)
+    runs = []
+    headers = []
+    pending = collections.deque()
+
+    def collect(res):
+        runs.extend(res[0])
+        headers.extend(h for h in res[1] if h not in headers)
+
+    try:
+        if second is None:
+            agg = _aggregate(first, cdx, keys, limit, headers, lambda agg: runs.append(_write_run(_sorted_items(agg), tmpdir)))
+            if not runs:
+                yield from headers
+                for kv in _sorted_items(agg):
+                    yield fmt % kv
+                return
+            if agg:
+                runs.append(_write_run(_sorted_items(agg), tmpdir))
+            del agg
+        else:
+            chunks = itertools.chain([first, second], chunks)
+            del first, second
+            if workers == 1:
+                for chunk in chunks:
+                    collect(_sort_chunk(chunk, cdx, tmpdir, keys, limit))
+            else:
+                with ProcessPoolExecutor(workers) as pool:
+                    for chunk in chunks:
+                        pending.append(pool.submit(_sort_chunk, chunk, cdx, tmpdir, keys, limit))
+                        del chunk
+                        if len(pending) >= workers:
+                            collect(pending.popleft().result())
+                    while pending:
+                        collect(pending.popleft().result())
+        yield from headers
+        yield from merge_runs(runs, tmpdir, fanin, fmt)
+    finally:
+        for future in pending:
+            if not future.cancel() and not future.exception():
+                runs.extend(future.result()[0])
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _shard_key(line, cdx=False, hdepth=8, pdepth=9):
+    try:
+        if cdx:
+            surtk = line.split(maxsplit=1)[0].split(b"?")[0].strip(b"/,")
+            if b")" not in surtk or surtk[:1] == b"!":
+                return
+        else:
+            if line[:1] == b"!":
+                return
+            parts = line.split(maxsplit=2)
+            surtk = parts[0].split(b"?")[0].strip(b"/,")
+            int(parts[1])
+    except Exception as e:
+        return
+    if b"," not in surtk:
+        return
+    host = surtk.partition(b")")[0].strip(b",").split(b",", hdepth-1)
+    return (host[0], b",".join(host[:2]) if len(host) > 1 else None, surtk.split(b"/", min(1, pdepth-1))[0])
+
+
+def _safe_split(prev, cur, hdepth=8):
+    if prev[0] != cur[0]:
+        return True
+    if hdepth == 1:
+        return prev[2] != cur[2]
+    return prev[1] is not None and cur[1] is not None and prev[1] != cur[1]
+
+
+def find_splits(infile, workers, cdx=False, hdepth=8, pdepth=9, **kw):
+    size = os.path.getsize(infile)
+    offsets = [0]
+    with open(infile, "rb") as f:
+        for i in range(1, workers):
+            target = max(size * i // workers, offsets[-1] + 1)
+            f.seek(target - 1)
+            f.readline()
+            pos = f.tell()
+            prev = None
+            for line in iter(f.readline, b""):
+                key = _shard_key(line, cdx, hdepth, pdepth)
+                if key:
+                    if prev and _safe_split(prev, key, hdepth):
+                        offsets.append(pos)
+                        break
+                    prev = key
+                pos += len(line)
+            else:
+                break
+    offsets.append(size)
+    return offsets
+
+
+def _read_range(infile, start, end):
+    with open(infile, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
+def _run_shard(op, infile, start, end, outfile, kw):
+    engine = Compactor(outfile, cdx=op is generate, **kw)
+    engine.feed(_read_range(infile, start, end))
+    return engine.close(), engine.hrollups, engine.prollups
+
+
+def _parallel(op, infile, outfile, workers=None, telemetry=None, **kw):
+    workers = workers or os.cpu_count()
+    opts = {k: kw[k] for k in ["hcf", "pcf", "ha", "hk", "pa", "pk", "hdepth", "pdepth"] if k in kw}
+    offsets = find_splits(infile, workers, cdx=op is generate, **opts)
+    tmpdir = os.path.dirname(os.path.abspath(outfile)) if isinstance(outfile, str) and outfile != "-" else None
+    shards = []
+    for _ in offsets[1:]:
+        fd, shard = tempfile.mkstemp(prefix=".mmshard-", dir=tmpdir)
+        os.close(fd)
+        shards.append(shard)
+    counts = {"inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "rollups": 0}
+    hrollups, prollups = [0] * opts.get("hdepth", 8), [0] * opts.get("pdepth", 9)
+    if telemetry:
+        telemetry.size += offsets[-1]
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(_run_shard, op, infile, start, end, shard, opts): i for i, (start, end, shard) in enumerate(zip(offsets, offsets[1:], shards))}
+            results = [None] * len(shards)
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i], hrollup, prollup = future.result()
+                hrollups = [a + b for a, b in zip(hrollups, hrollup)]
+                prollups = [a + b for a, b in zip(prollups, prollup)]
+                if telemetry:
+                    telemetry.lines += results[i]["inlines"]
+                    telemetry.done += offsets[i + 1] - offsets[i]
+                    telemetry.progress(force=True)
+        opf, owned = _open_output(outfile)
+        for shard, res in zip(shards, results):
+            with open(shard, "rb") as sf:
+                shutil.copyfileobj(sf, opf, 1 << 20)
+            for k in counts:
+                counts[k] += res[k]
+        if owned:
+            opf.close()
+        else:
+            opf.flush()
+    finally:
+        for shard in shards:
+            os.remove(shard)
+    if telemetry:
+        telemetry.record(shards=len(shards), rollup_depths={"host": _depths(hrollups), "path": _depths(prollups)})
+    if kw.get("bloom"):
+        _output_bloom(outfile, kw["bloom"], counts)
+    return counts
+
+
+def parallel_generate(infile, outfile, workers=None, hcf=float("inf"), pcf=float("inf"), **kw):
+    return _parallel(generate, infile, outfile, workers, hcf=hcf, pcf=pcf, **kw)
+
+
+def parallel_compact(infile, outfile, workers=None, hcf=1.0, pcf=1.0, **kw):
+    return _parallel(compact, infile, outfile, workers, hcf=hcf, pcf=pcf, **kw)
 
 
 def bin_search(mmapiter, key):
-    surtk, freq, *_ = mmapiter.readline().split(maxsplit=2)
+    mmapiter.seek(0)
+    surtk, freq, *_ = mmapiter.readline().split(maxsplit=2) or [None, None]
     if key == surtk:
         return [surtk, freq]
     left = 0
@@ -139,7 +831,11 @@ def bin_search(mmapiter, key):
         mid = (right + left) // 2
         mmapiter.seek(mid)
         mmapiter.readline()
-        surtk, freq, *_ = mmapiter.readline().split(maxsplit=2)
+        line = mmapiter.readline()
+        if not line:
+            right = mid
+            continue
+        surtk, freq, *_ = line.split(maxsplit=2)
         if key == surtk:
             return [surtk, freq]
         elif key > surtk:
@@ -148,24 +844,651 @@ def bin_search(mmapiter, key):
             right = mid
 
 
-def lookup_keys(surt):
-    keyre = re.compile(r"(.+)([,/]).+")
-    key = surt.split("?")[0].strip("/")
-    keys = [key, f"{key}/*"]
-    while "," in key:
-        if key.endswith(")"):
-            keys.append(key.strip(")") + ",*")
-        try:
-            m = keyre.match(key)
-            keys.append(f"{m[1]}{m[2]}*")
+def _lookup_keys(surt):
+    key = surt.split(b"?")[0].strip(b"/")
+    keys = [key, key + b"/*"]
+    while b"," in key:
+        if key.endswith(b")"):
+            keys.append(key.strip(b")") + b",*")
+        m = keyre.match(key)
+        if m:
+            keys.append(m[1] + m[2] + b"*")
             key = m[1]
-        except Exception as e:
-            key = key.strip("/,")
+        else:
+            key = key.strip(b"/,")
     return keys
 
 
-def lookup(mmapiter, surt, **kw):
-    for idx, key in enumerate(lookup_keys(surt)):
-        res = bin_search(mmapiter, key.encode())
+def lookup_keys(surt):
+    return [key.decode() for key in _lookup_keys(surt.encode())]
+
+
+def build_index(mmapfile, idxfile=None, blocksize=64, **kw):
+    idxfile = idxfile or f"{mmapfile}.idx"
+    st = os.stat(mmapfile)
+    counts = {"blocks": 0, "inbytes": st.st_size, "outbytes": 0}
+    with open(mmapfile, "rb") as f, open(idxfile, "wb") as opf:
+        opf.write(b"!mementomap-index %d %d %d\n" % (st.st_size, st.st_mtime_ns, blocksize))
+        pos = nextblock = 0
+        for line in f:
+            if pos >= nextblock and line[:1] != b"!" and line.strip():
+                opf.write(line.split(maxsplit=1)[0] + b" %d\n" % pos)
+                counts["blocks"] += 1
+                nextblock = pos + blocksize * 1024
+            pos += len(line)
+        counts["outbytes"] = opf.tell()
+    return counts
+
+
+class StaleSidecarError(ValueError):
+    pass
+
+
+def _check_sidecar(header, magic, mmapfile, sidecar):
+    st = os.stat(mmapfile)
+    try:
+        fresh = header[:1] == [magic] and [int(v) for v in header[1:3]] == [st.st_size, st.st_mtime_ns]
+    except ValueError:
+        fresh = False
+    if not fresh:
+        raise StaleSidecarError(f"Stale or invalid {sidecar} for {mmapfile}")
+
+
+def load_index(mmapfile, idxfile=None):
+    idxfile = idxfile or f"{mmapfile}.idx"
+    with open(idxfile, "rb") as f:
+        _check_sidecar(f.readline().split(), b"!mementomap-index", mmapfile, f"index {idxfile}")
+        keys = []
+        offsets = []
+        for line in f:
+            key, offset = line.split()
+            keys.append(key)
+            offsets.append(int(offset))
+    return keys, offsets
+
+
+class BloomFilter:
+    def __init__(self, nbits, k, bits=None):
+        self.nbits = nbits
+        self.k = k
+        self.bits = bits if bits is not None else bytearray((nbits + 7) // 8)
+
+    @classmethod
+    def sized(cls, capacity, fpr=0.01):
+        capacity = max(capacity, 1)
+        nbits = max(64, math.ceil(-capacity * math.log(fpr) / math.log(2) ** 2))
+        return cls(nbits, max(1, round(nbits / capacity * math.log(2))))
+
+    def _positions(self, key):
+        h = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.k)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & 1 << (pos & 7):
+                return False
+        return True
+
+
+def _map_keys(mmapfile):
+    with open(mmapfile, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for key, freq in BinaryMap(mm).entries():
+                    yield key
+            return
+        f.seek(0)
+        for line in f:
+            if line[:1] != b"!" and line.strip():
+                yield line.split(maxsplit=1)[0]
+
+
+def build_bloom(mmapfile, bloomfile=None, fpr=0.01, capacity=None, **kw):
+    bloomfile = bloomfile or f"{mmapfile}.bloom"
+    st = os.stat(mmapfile)
+    if capacity is None:
+        capacity = sum(1 for key in _map_keys(mmapfile))
+    bf = BloomFilter.sized(capacity, fpr)
+    counts = {"keys": 0, "inbytes": st.st_size, "outbytes": 0}
+    for key in _map_keys(mmapfile):
+        bf.add(key)
+        counts["keys"] += 1
+    with open(bloomfile, "wb") as opf:
+        opf.write(b"!mementomap-bloom %d %d %d %d %d\n" % (st.st_size, st.st_mtime_ns, bf.nbits, bf.k, counts["keys"]))
+        opf.write(bf.bits)
+        counts["outbytes"] = opf.tell()
+    return counts
+
+
+def _output_bloom(outfile, fpr, counts):
+    if isinstance(outfile, str) and outfile != "-" and not outfile.endswith(".gz"):
+        build_bloom(outfile, fpr=fpr, capacity=counts["outlines"])
+
+
+def load_bloom(mmapfile, bloomfile=None):
+    bloomfile = bloomfile or f"{mmapfile}.bloom"
+    with open(bloomfile, "rb") as f:
+        header = f.readline().split()
+        _check_sidecar(header, b"!mementomap-bloom", mmapfile, f"filter {bloomfile}")
+        nbits, k = int(header[3]), int(header[4])
+        return BloomFilter(nbits, k, bytearray(f.read()))
+
+
+def index_search(mmapiter, index, key):
+    keys, offsets = index
+    i = bisect.bisect_right(keys, key) - 1
+    if i < 0:
+        return
+    start = offsets[i]
+    end = offsets[i+1] if i + 1 < len(offsets) else len(mmapiter)
+    if mmapiter[start:start+len(key)+1] == key + b" ":
+        pos = start
+    else:
+        pos = mmapiter.find(b"\n" + key + b" ", start, min(end + len(key) + 1, len(mmapiter))) + 1
+        if not pos:
+            return
+    eol = mmapiter.find(b"\n", pos)
+    surtk, freq, *_ = mmapiter[pos:eol if eol >= 0 else len(mmapiter)].split(maxsplit=2)
+    return [surtk, freq]
+
+
+def parse_named_path(spec):
+    name, sep, path = spec.partition("=")
+    if not sep:
+        return os.path.basename(spec).split(".")[0], spec
+    return name, path
+
+
+class MementoMapReader:
+    def __init__(self, mmapfile, cache_size=4096, index=True, bloom=True):
+        self.mmapfile = mmapfile
+        self.fobj = open(mmapfile, "rb")
+        self.mmapiter = self.fobj
+        try:
+            if os.fstat(self.fobj.fileno()).st_size:
+                self.mmapiter = mmap.mmap(self.fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            self.binary = None
+            if self.mmapiter is not self.fobj and self.mmapiter[:len(MAGIC)] == MAGIC:
+                self.binary = BinaryMap(self.mmapiter)
+            self.index = None
+            if index and not self.binary and os.path.exists(f"{mmapfile}.idx"):
+                self.index = load_index(mmapfile)
+            self.bloom = None
+            if bloom and os.path.exists(f"{mmapfile}.bloom"):
+                self.bloom = load_bloom(mmapfile)
+        except BaseException:
+            self.close()
+            raise
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.distances = {}
+
+    @classmethod
+    def open_with_fallback(cls, mmapfile, cache_size=4096):
+        try:
+            return cls(mmapfile, cache_size=cache_size)
+        except StaleSidecarError as e:
+            print(f"{e}, falling back to binary search", file=sys.stderr)
+            return cls(mmapfile, cache_size=cache_size, index=False, bloom=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.mmapiter is not self.fobj:
+            self.mmapiter.close()
+        self.fobj.close()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped, "cached": len(self.cache), "distances": dict(self.distances)}
+
+    def search(self, key):
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        if self.bloom and key not in self.bloom:
+            self.skipped += 1
+            return None
+        if self.binary:
+            res = self.binary.search(key)
+        elif self.index:
+            res = index_search(self.mmapiter, self.index, key)
+        else:
+            res = bin_search(self.mmapiter, key)
+        if self.cache_size:
+            self.cache[key] = res
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return res
+
+    def lookup(self, surt, **kw):
+        for idx, key in enumerate(_lookup_keys(surt.encode())):
+            res = self.search(key)
+            if res:
+                self.distances[str(idx)] = self.distances.get(str(idx), 0) + 1
+                return {"surtk": res[0].decode(), "freq": res[1].decode(), "dist": str(idx), "surt": surt}
+        self.distances["miss"] = self.distances.get("miss", 0) + 1
+
+
+def lookup(mmapiter, surt, index=None, **kw):
+    if isinstance(mmapiter, MementoMapReader):
+        return mmapiter.lookup(surt)
+    for idx, key in enumerate(_lookup_keys(surt.encode())):
+        if index:
+            res = index_search(mmapiter, index, key)
+        else:
+            res = bin_search(mmapiter, key)
         if res:
             return {"surtk": res[0].decode(), "freq": res[1].decode(), "dist": str(idx), "surt": surt}
+
+
+def sorted_lookup(mmapiter, surts, lookahead=4096, **kw):
+    reader = mmapiter
+    if isinstance(mmapiter, MementoMapReader):
+        mmapiter = reader.mmapiter
+
+    def _entries():
+        pos = 0
+        while True:
+            if mmapiter.tell() != pos:
+                mmapiter.seek(pos)
+            line = mmapiter.readline()
+            if not line:
+                return
+            pos += len(line)
+            parts = line.split(maxsplit=2)
+            if len(parts) > 1 and line[:1] != b"!":
+                yield parts[0], parts[1]
+
+    def _probe(key):
+        if key not in probed:
+            if len(probed) >= lookahead:
+                probed.clear()
+            res = reader.search(key) if reader is not mmapiter else bin_search(mmapiter, key)
+            probed[key] = res[1] if res else None
+        return probed[key]
+
+    if getattr(reader, "binary", None):
+        entries = reader.binary.entries()
+    else:
+        mmapiter.seek(0)
+        entries = _entries()
+    distances = getattr(reader, "distances", None)
+    # Entries at or past the current key, at most lookahead of them, and the wildcards already passed
+    window = {}
+    order = collections.deque()
+    stack = []
+    probed = {}
+    high = low = prev = None
+    eof = False
+
+    def _passed(key, freq):
+        if key.endswith(b"/*") or key.endswith(b",*"):
+            while stack and not _covers(stack[-1][0], key):
+                stack.pop()
+            stack.append((key, freq))
+        return key
+
+    for surt in surts:
+        if prev is not None and surt < prev:
+            raise ValueError(f"Input is not sorted: {surt} after {prev}")
+        prev = surt
+        keys = _lookup_keys(surt.encode())
+        while order and order[0] < keys[0]:
+            low = _passed(order[0], window.pop(order.popleft()))
+        if low is not None and keys[0] <= low:
+            yield lookup(reader, surt)
+            continue
+        res = None
+        for idx, key in enumerate(keys):
+            while not eof and (high is None or high < key) and len(order) < lookahead:
+                entry = next(entries, None)
+                if entry is None:
+                    eof = True
+                    break
+                high = entry[0]
+                if high < keys[0]:
+                    low = _passed(*entry)
+                elif high not in window:
+                    window[high] = entry[1]
+                    order.append(high)
+            if low is not None and key <= low:
+                freq = next((f for w, f in stack if w == key), None)
+            elif key in window or eof or high >= key:
+                freq = window.get(key)
+            else:
+                freq = _probe(key)
+            if freq is not None:
+                res = {"surtk": key.decode(), "freq": freq.decode(), "dist": str(idx), "surt": surt}
+                break
+        if distances is not None:
+            dist = res["dist"] if res else "miss"
+            distances[dist] = distances.get(dist, 0) + 1
+        yield res
+
+
+def _cover_keys(key):
+    if key.endswith(b"/*"):
+        keys = _lookup_keys(key[:-2])
+    elif key.endswith(b",*"):
+        keys = _lookup_keys(key[:-2] + b")")
+    else:
+        return _lookup_keys(key)[1:]
+    return keys[keys.index(key)+1:] if key in keys else keys[1:]
+
+
+def _covers(wkey, key):
+    base = wkey[:-2]
+    if wkey.endswith(b"/*"):
+        return key == base or key.startswith(base + b"/")
+    return key.startswith(base + b")") or key.startswith(base + b",")
+
+
+def _ukvs_entries(infiter, headers, counts):
+    for line in infiter:
+        counts["inlines"] += 1
+        counts["inbytes"] += len(line)
+        if line[:1] == b"!":
+            line = line.rstrip(b"\r\n") + b"\n"
+            if line not in headers:
+                headers.append(line)
+            continue
+        try:
+            parts = line.split(maxsplit=2)
+            yield parts[0], int(parts[1])
+        except Exception as e:
+            continue
+
+
+def merge_iter(infiters, counts=None):
+    if counts is None:
+        counts = {}
+    for k in ["inlines", "outlines", "inbytes", "outbytes", "absorbed"]:
+        counts.setdefault(k, 0)
+    headers = []
+    entries = [_ukvs_entries(it, headers, counts) for it in infiters]
+    heap = []
+    for idx, ent in enumerate(entries):
+        head = next(ent, None)
+        if head:
+            heap.append([head[0], idx, head[1]])
+    heapq.heapify(heap)
+    for line in headers:
+        counts["outlines"] += 1
+        counts["outbytes"] += len(line)
+        yield line
+    pending = collections.deque()
+    active = []
+
+    def _blocked(entry):
+        # Any stream whose head is not past a covering wildcard can still yield it
+        if entry[3]:
+            return True
+        return bool(heap) and any(wkey >= heap[0][0] for wkey in entry[2])
+
+    while heap:
+        key, freq = heap[0][0], 0
+        while heap and heap[0][0] == key:
+            idx = heap[0][1]
+            freq += heap[0][2]
+            nxt = next(entries[idx], None)
+            if nxt:
+                heapq.heapreplace(heap, [nxt[0], idx, nxt[1]])
+            else:
+                heapq.heappop(heap)
+        while active and not _covers(active[-1][0], key):
+            active.pop()[3] = False
+        if active:
+            active[-1][1] += freq
+            counts["absorbed"] += 1
+        else:
+            entry = [key, freq, _cover_keys(key), False]
+            if key.endswith(b"/*") or key.endswith(b",*"):
+                low = key[:-2] if key.endswith(b"/*") else key[:-2] + b")"
+                kept = []
+                while pending and pending[-1][0] >= low:
+                    prev = pending.pop()
+                    if _covers(key, prev[0]):
+                        entry[1] += prev[1]
+                        counts["absorbed"] += 1
+                    else:
+                        kept.append(prev)
+                pending.extend(reversed(kept))
+                entry[3] = True
+                active.append(entry)
+            pending.append(entry)
+        if not heap:
+            for entry in active:
+                entry[3] = False
+        while pending and not _blocked(pending[0]):
+            entry = pending.popleft()
+            line = entry[0] + b" %d\n" % entry[1]
+            counts["outlines"] += 1
+            counts["outbytes"] += len(line)
+            yield line
+
+
+def merge(infiters, outfile, **kw):
+    counts = {}
+    opf, owned = _open_output(outfile)
+    opf.writelines(merge_iter(infiters, counts))
+    if owned:
+        opf.close()
+    else:
+        opf.flush()
+    return counts
+
+
+def _subtree(surtk):
+    return b",".join(surtk.partition(b")")[0].split(b",", 2)[:2])
+
+
+def _seek_subtree(mm, subtree, lo=0, past=False):
+    hi = len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = mm.rfind(b"\n", lo, mid) + 1 or lo
+        eol = mm.find(b"\n", pos)
+        if eol < 0:
+            eol = len(mm)
+        parts = mm[pos:eol].split(None, 1)
+        st = _subtree(parts[0]) if parts else b""
+        if st < subtree or past and st == subtree:
+            lo = eol + 1
+        else:
+            hi = pos
+    return min(lo, len(mm))
+
+
+def _mmap_lines(mm, start, end):
+    if start < end:
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline()
+
+
+def update(mmapfile, infiter, outfile, hcf=float("inf"), pcf=float("inf"), ha=16.329, hk=0.714, pa=24.546, pk=1.429, hdepth=8, pdepth=9, bloom=None, telemetry=None, **kw):
+    if isinstance(outfile, str) and os.path.exists(outfile) and os.path.samefile(mmapfile, outfile):
+        raise ValueError("Cannot update a MementoMap in place, write to a new file")
+    if is_binary(mmapfile):
+        raise ValueError("Cannot update a binary MementoMap, convert it to UKVS first")
+    counts = {"inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0, "rollups": 0, "subtrees": 0, "copied": 0}
+    opf, owned = _open_output(outfile)
+
+    def copy(start, end):
+        for i in range(start, end, 1 << 20):
+            chunk = mm[i:min(i + (1 << 20), end)]
+            opf.write(chunk)
+            counts["outlines"] += chunk.count(b"\n")
+            counts["outbytes"] += len(chunk)
+        counts["copied"] += end - start
+
+    def delta(lines):
+        for line in lines:
+            counts["inlines"] += 1
+            counts["inbytes"] += len(line)
+            yield line
+
+    with open(mmapfile, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        pos = 0
+        prev = None
+        hrollups, prollups = [0] * hdepth, [0] * pdepth
+        for subtree, lines in itertools.groupby(infiter, lambda line: _subtree(line.split(None, 1)[0] if line.strip() else b"")):
+            if not subtree:
+                continue
+            if prev is not None and subtree <= prev:
+                raise ValueError("Delta input is not sorted by SURT, use --sort")
+            prev = subtree
+            start = _seek_subtree(mm, subtree, pos)
+            end = _seek_subtree(mm, subtree, start, past=True)
+            copy(pos, start)
+            engine = Compactor(opf, hcf, pcf, ha, hk, pa, pk, hdepth, pdepth)
+            engine.feed(merge_iter([_mmap_lines(mm, start, end), delta(lines)]))
+            res = engine.close()
+            for k in ["outlines", "outbytes", "rollups"]:
+                counts[k] += res[k]
+            hrollups = [a + b for a, b in zip(hrollups, engine.hrollups)]
+            prollups = [a + b for a, b in zip(prollups, engine.prollups)]
+            if telemetry:
+                telemetry.lines, telemetry.position = counts["inlines"], subtree
+                telemetry.progress()
+            counts["subtrees"] += 1
+            pos = end
+        copy(pos, len(mm))
+        if isinstance(mm, mmap.mmap):
+            mm.close()
+    if owned:
+        opf.close()
+    else:
+        opf.flush()
+    if bloom:
+        _output_bloom(outfile, bloom, counts)
+    return counts
+
+
+def _route_entries(infiter, idx, headers, counts):
+    for key, freq in _ukvs_entries(infiter, headers, counts):
+        yield key, idx, freq
+
+
+def route_index(infiters, outfile, names, **kw):
+    if len(set(names)) != len(names) or any(not name or len(name.split()) != 1 for name in names):
+        raise ValueError("Archive names must be unique and without whitespace")
+    counts = {"archives": len(names), "inlines": 0, "outlines": 0, "inbytes": 0, "outbytes": 0}
+    headers = []
+    entries = heapq.merge(*[_route_entries(it, idx, headers, counts) for idx, it in enumerate(infiters)])
+    head = next(entries, None)
+    opf, owned = _open_output(outfile)
+    for line in [b"!mementomap-route " + " ".join(names).encode() + b"\n"] + headers:
+        opf.write(line)
+        counts["outlines"] += 1
+        counts["outbytes"] += len(line)
+    key, mask, freqs = None, 0, {}
+    for k, idx, freq in itertools.chain([head] if head else [], entries):
+        if k != key:
+            if key is not None:
+                line = key + b" %x:%s\n" % (mask, b",".join(b"%d" % freqs[i] for i in sorted(freqs)))
+                opf.write(line)
+                counts["outlines"] += 1
+                counts["outbytes"] += len(line)
+            key, mask, freqs = k, 0, {}
+        mask |= 1 << idx
+        freqs[idx] = freqs.get(idx, 0) + freq
+    if key is not None:
+        line = key + b" %x:%s\n" % (mask, b",".join(b"%d" % freqs[i] for i in sorted(freqs)))
+        opf.write(line)
+        counts["outlines"] += 1
+        counts["outbytes"] += len(line)
+    if owned:
+        opf.close()
+    else:
+        opf.flush()
+    return counts
+
+
+def route_names(mmapiter):
+    if isinstance(mmapiter, MementoMapReader) and mmapiter.binary:
+        header = b"".join(mmapiter.binary.headers[:1]).split()
+    else:
+        if isinstance(mmapiter, MementoMapReader):
+            mmapiter = mmapiter.mmapiter
+        mmapiter.seek(0)
+        header = mmapiter.readline().split()
+    if header[:1] != [b"!mementomap-route"]:
+        raise ValueError("Not a MementoMap route index")
+    return [name.decode() for name in header[1:]]
+
+
+def route(mmapiter, surt, names=None, index=None, **kw):
+    names = names or route_names(mmapiter)
+    res = dict.fromkeys(names)
+    pending = (1 << len(names)) - 1
+    for idx, key in enumerate(_lookup_keys(surt.encode())):
+        if isinstance(mmapiter, MementoMapReader):
+            hit = mmapiter.search(key)
+        elif index:
+            hit = index_search(mmapiter, index, key)
+        else:
+            hit = bin_search(mmapiter, key)
+        if not hit:
+            continue
+        mask, _, freqs = hit[1].partition(b":")
+        mask = int(mask, 16)
+        freqs = freqs.split(b",")
+        bit = j = 0
+        while mask >> bit:
+            if mask >> bit & 1:
+                if pending >> bit & 1:
+                    res[names[bit]] = {"surtk": key.decode(), "freq": freqs[j].decode(), "dist": str(idx), "surt": surt}
+                j += 1
+            bit += 1
+        pending &= ~mask
+        if not pending:
+            break
+    if isinstance(mmapiter, MementoMapReader):
+        for hit in res.values():
+            dist = hit["dist"] if hit else "miss"
+            mmapiter.distances[dist] = mmapiter.distances.get(dist, 0) + 1
+    return res
+
+
+def convert(infile, outfile, blocksize=4, codec="none", **kw):
+    if infile == "-" or not is_binary(infile):
+        if isinstance(outfile, str) and outfile.endswith(".gz"):
+            raise ValueError("A binary MementoMap cannot be GZipped, use a block codec instead")
+        fobj = open_input(infile)
+        opf, owned = _open_output(outfile)
+        counts = write_binary(fobj, opf, blocksize << 10, codec)
+        fobj.close()
+    else:
+        counts = {"inlines": 0, "outlines": 0, "inbytes": os.path.getsize(infile), "outbytes": 0, "blocks": 0}
+        opf, owned = _open_output(outfile)
+        with MementoMapReader(infile, index=False, bloom=False) as reader:
+            counts["blocks"] = len(reader.binary.blocks)
+            for line in reader.binary.lines():
+                opf.write(line)
+                counts["outlines"] += 1
+                counts["outbytes"] += len(line)
+        counts["inlines"] = counts["outlines"]
+    if owned:
+        opf.close()
+    else:
+        opf.flush()
+    return counts
@@ -0,0 +1,128 @@
+import functools
+import re
+import time
+
+matchers = {
+    "clog": re.compile(r'^(?P<host>\S+)\s+(?P<identity>\S+)\s+(?P<user>\S+)\s+\[(?P<origtime>.+?)\]\s+"(?P<request>.*?)"\s+(?P<status>\S+)\s+(?P<size>\S+)(\s+"(?P<referrer>.*?)"\s+"(?P<agent>.*?)"\s*(?P<extras>.*?))?\s*$'),
+    "hreq": re.compile(r'^(?P<method>[A-Z]+)\s+([hH][tT]{2}[pP][sS]?://[\w\-\.]+(:\d+)?)?(?P<path>\S+)\s+(?P<httpv>HTTP\/\d(\.\d)?)$'),
+    "urim": re.compile(r'^(?P<prefix>[\w\-\/]*?\/)(?P<mtime>\d{14})((?P<rflag>[a-z]{2}_))?\/(?P<urir>\S+)$'),
+    "uri": re.compile(r'^(?:[a-zA-Z][\w+.\-]*:/+)?(?P<authority>[^/?#]*)(?P<path>[^?#]*)')
+}
+
+validators = {
+    "host": re.compile(r'^((25[0-5]|(2[0-4]|1\d?|[2-9])?\d)(\.(25[0-5]|(2[0-4]|1\d?|[2-9])?\d)){3})|([\da-fA-F]{0,4}:){2,7}[\da-fA-F]{0,4}$'),
+    "request": re.compile(r'^[A-Z]+\s+\S+\s+HTTP\/\d(\.\d)?$'),
+    "status": re.compile(r'^[1-5]\d{2}$'),
+    "size": re.compile(r'^\-|\d+$'),
+    "referrer": re.compile(r'^(https?://[\w\-\.]+(:\d+)?(/(\S)*)?)?$', re.I)
+}
+
+origtime_format = "%d/%b/%Y:%H:%M:%S %z"
+ipv4re = re.compile(r'^\d+(\.\d+){3}$')
+wwwre = re.compile(r'^www\d*\.')
+
+formatting_fields = {
+    "origline": "Original log line",
+    "host": "IP address of the client",
+    "identity": "Identity of the client, usually '-'",
+    "user": "User ID for authentication, usually '-'",
+    "origtime": "Original date and time (typically in '%d/%b/%Y:%H:%M:%S %z' format)",
+    "epoch": "Seconds from the Unix epoch (derived from origtime)",
+    "date": "UTC date in '%Y-%m-%d' format (derived from origtime)",
+    "time": "UTC time in '%H:%M:%S' format (derived from origtime)",
+    "datetime": "14 digit datetime in '%Y%m%d%H%M%S' format (derived from origtime)",
+    "request": "Original HTTP request line",
+    "method": "HTTP method (empty for invalid request)",
+    "path": "Path and query (scheme and host removed, empty for invalid request)",
+    "prefix": "Memento endpoint path prefix (derived from path)",
+    "mtime": "14 digit Memento datetime (derived from path)",
+    "rflag": "Memento rewrite flag (derived from path)",
+    "urir": "Memento URI-R (derived from path)",
+    "httpv": "HTTP version (empty for invalid request)",
+    "status": "Returned status code",
+    "size": "Number of bytes returned",
+    "referrer": "Referer header (empty, if not logged)",
+    "agent": "User-agent header (empty, if not logged)",
+    "extras": "Any additional logged fields"
+}
+
+
+@functools.lru_cache(maxsize=65536)
+def convert_time(origtime, origtime_format):
+    et = time.mktime(time.strptime(origtime, origtime_format))
+    ut = time.gmtime(et)
+    return int(et), time.strftime("%Y-%m-%d", ut), time.strftime("%H:%M:%S", ut), time.strftime("%Y%m%d%H%M%S", ut)
+
+
+def parse_record(line, non_empty_fields=[], validate_fields=[], field_matches=[], origtime_format="%d/%b/%Y:%H:%M:%S %z"):
+    m = matchers["clog"].match(line)
+    if not m:
+        raise ValueError("Malformed record")
+
+    record = {fld: "" for fld in formatting_fields}
+    record["origline"] = line
+    record.update(m.groupdict(default=""))
+
+    for fld in validate_fields:
+        reg = validators.get(fld)
+        val = record.get(fld, "")
+        if reg and not reg.match(val):
+            raise ValueError(f"Invalid field {fld}: {val}")
+
+    try:
+        record["epoch"], record["date"], record["time"], record["datetime"] = convert_time(record["origtime"], origtime_format)
+    except Exception as e:
+        raise ValueError(f"Invalid time: {record['origtime']}")
+
+    m = matchers["hreq"].match(record["request"])
+    if m:
+        record.update(m.groupdict(default=""))
+
+    m = matchers["urim"].match(record["path"])
+    if m:
+        record.update(m.groupdict(default=""))
+
+    for fld in non_empty_fields:
+        if record.get(fld, "") in ["", "-"]:
+            raise ValueError(f"Empty field: {fld}")
+
+    for (fld, reg) in field_matches:
+        val = record.get(fld, "")
+        m = reg.search(val)
+        if not m:
+            raise ValueError(f"Mismatch field {fld}: {val}")
+
+    return record
+
+
+def parse_field_match(spec):
+    fm = spec.split("~", 1)
+    if len(fm) != 2 or fm[0] not in formatting_fields.keys() or not fm[1]:
+        raise ValueError(f"'{spec}' is not a valid field match option (use 'FIELD~RegEg' instead)")
+    try:
+        return fm[0], re.compile(fm[1])
+    except Exception as e:
+        raise ValueError(f"'{fm[1]}' is not a valid Regular Expression")
+
+
+def to_surt(uri):
+    m = matchers["uri"].match(uri.strip())
+    host, _, port = m["authority"].rpartition("@")[2].lower().partition(":")
+    host = host.strip(".")
+    if not host:
+        return None
+    if not ipv4re.match(host):
+        host = ",".join(reversed(wwwre.sub("", host).split(".")))
+    port = f":{port}" if port not in ["", "80", "443"] else ""
+    return f"{host}{port}){m['path'].lower() or '/'}"
+
+
+def log_keys(chunk, field_matches=[], origtime_format=origtime_format):
+    for line in chunk.split(b"\n"):
+        try:
+            record = parse_record(line.decode().strip(), field_matches=field_matches, origtime_format=origtime_format)
+        except Exception as e:
+            continue
+        surt = record["urir"] and to_surt(record["urir"])
+        if surt:
+            yield surt.encode()
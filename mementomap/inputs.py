@@ -0,0 +1,198 @@
+import bz2
+import collections
+import io
+import lzma
+import os
+import re
+import sys
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mementomap.cdxapi import CDXAPIReader, is_remote
+from mementomap.queued import QueuedReader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = {
+    ".gz": (re.compile(rb"\x1f\x8b\x08[\x00-\x1f]"), lambda: zlib.decompressobj(31)),
+    ".bz2": (re.compile(rb"BZh[1-9](?:1AY&SY|\x17rE8P\x90)"), bz2.BZ2Decompressor),
+    ".xz": (re.compile(rb"\xfd7zXZ\x00"), lzma.LZMADecompressor),
+}
+if zstandard:
+    CODECS[".zst"] = (re.compile(rb"\x28\xb5\x2f\xfd"), lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def codec_of(infile):
+    ext = os.path.splitext(infile)[1]
+    if ext == ".zst" and not zstandard:
+        raise ValueError(f"Reading {infile} requires the zstandard package")
+    return ext if ext in CODECS else None
+
+
+def _find_member(f, pattern, pos, end=None, blocksize=1 << 20):
+    # Only a header starting before end belongs to this segment, read up to 15 bytes past it for the match
+    f.seek(pos)
+    tail = b""
+    while end is None or pos < end:
+        data = f.read(blocksize if end is None else min(blocksize, end + 15 - pos))
+        if not data:
+            return None
+        m = pattern.search(tail + data)
+        if m and (end is None or pos - len(tail) + m.start() < end):
+            return pos - len(tail) + m.start()
+        tail = data[-15:]
+        pos += len(data)
+    return None
+
+
+def _decode_members(f, codec, start, end=None, blocksize=1 << 20, emit=None, counts=None):
+    # Decode whole members starting at start until a member ends at or past end, return (stop, chunks)
+    new = CODECS[codec][1]
+    f.seek(start)
+    chunks = []
+    fed = start
+    d = new()
+    fresh = True
+    data = b""
+    while True:
+        if not data:
+            data = f.read(blocksize)
+            if counts is not None:
+                counts["inbytes"] += len(data)
+            if not data:
+                if not fresh:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                return fed, chunks
+            fed += len(data)
+        if fresh:
+            pad = len(data) - len(data.lstrip(b"\x00"))
+            data = data[pad:]
+            if not data:
+                continue
+        out = d.decompress(data)
+        fresh = False
+        if out:
+            if emit:
+                if not emit(out):
+                    return fed, chunks
+            else:
+                chunks.append(out)
+        if not d.eof:
+            data = b""
+            continue
+        data = d.unused_data
+        stop = fed - len(data)
+        if end is not None and stop >= end:
+            return stop, chunks
+        d = new()
+        fresh = True
+
+
+def _multistream(infile, codec, limit=8 << 20, blocksize=1 << 20):
+    d = CODECS[codec][1]()
+    with open(infile, "rb") as f:
+        fed = 0
+        while fed < limit:
+            data = f.read(blocksize)
+            if not data:
+                return False
+            fed += len(data)
+            d.decompress(data)
+            if d.eof:
+                return bool(d.unused_data.strip(b"\x00") or f.read(1))
+    return False
+
+
+def _segment(infile, codec, start, end, blocksize):
+    with open(infile, "rb") as f:
+        if start:
+            start = _find_member(f, CODECS[codec][0], start, end, blocksize)
+            if start is None:
+                return end, end, []
+        try:
+            stop, chunks = _decode_members(f, codec, start, end, blocksize)
+        except Exception as e:
+            return start, None, None
+    return start, stop, chunks
+
+
+class PipelinedReader(QueuedReader):
+    def __init__(self, infile, codec=None, workers=None, blocksize=1 << 20, segsize=1 << 20, queue_size=16):
+        self.infile = infile
+        self.codec = codec or codec_of(infile)
+        self.workers = workers or os.cpu_count() or 1
+        self.blocksize = blocksize
+        self.segsize = segsize
+        self.parallel = self.workers > 1 and _multistream(infile, self.codec, blocksize=blocksize)
+        super().__init__({"inbytes": 0, "outbytes": 0, "chunks": 0, "segments": 0, "fallbacks": 0, "decode_seconds": 0.0}, queue_size)
+
+    def _emit(self, chunk):
+        self.counts["outbytes"] += len(chunk)
+        self.counts["chunks"] += 1
+        self._put(chunk)
+        return not self.stopped.is_set()
+
+    def _produce(self):
+        t = time.perf_counter()
+        try:
+            if self.parallel:
+                self._produce_parallel()
+            else:
+                with open(self.infile, "rb") as f:
+                    _decode_members(f, self.codec, 0, blocksize=self.blocksize, emit=self._emit, counts=self.counts)
+        except Exception as e:
+            self._put(e)
+        self.counts["decode_seconds"] = time.perf_counter() - t
+        self._put(None)
+
+    def _produce_parallel(self):
+        size = os.path.getsize(self.infile)
+        self.counts["inbytes"] = size
+        pos = 0
+        with ThreadPoolExecutor(self.workers) as executor, open(self.infile, "rb") as f:
+            pending = collections.deque()
+            for seg in range(0, size, self.segsize):
+                pending.append((seg + self.segsize, executor.submit(_segment, self.infile, self.codec, seg, seg + self.segsize, self.blocksize)))
+                if len(pending) <= self.workers:
+                    continue
+                pos = self._collect(f, pos, *pending.popleft())
+                if self.stopped.is_set():
+                    return
+            while pending:
+                pos = self._collect(f, pos, *pending.popleft())
+
+    def _collect(self, f, pos, end, future):
+        start, stop, chunks = future.result()
+        self.counts["segments"] += 1
+        if pos >= end:
+            return pos
+        if stop is not None and start and start > pos:
+            f.seek(pos)
+            if not f.read(start - pos).strip(b"\x00"):
+                pos = start
+        if stop is None or start != pos:
+            self.counts["fallbacks"] += 1
+            stop, chunks = _decode_members(f, self.codec, pos, end, self.blocksize)
+        for chunk in chunks:
+            self._emit(chunk)
+        return stop
+
+
+def open_input(infile, workers=None, blocksize=1 << 20, concurrency=8, retries=3):
+    if infile == "-":
+        return sys.stdin.buffer
+    if is_remote(infile):
+        return io.BufferedReader(CDXAPIReader(infile, concurrency, retries), 1 << 20)
+    codec = codec_of(infile)
+    if not codec:
+        return open(infile, "rb")
+    return io.BufferedReader(PipelinedReader(infile, codec, workers, blocksize), 1 << 20)
+
+
+def input_counts(fobj):
+    return getattr(getattr(fobj, "raw", None), "counts", None)
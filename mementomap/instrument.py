@@ -0,0 +1,169 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from mementomap.inputs import input_counts
+
+
+class Metered:
+    def __init__(self, fobj, telemetry, stage="read"):
+        self.fobj = fobj
+        self.telemetry = telemetry
+        self.stage = stage
+        self.lines = 0
+
+    def read(self, size=-1):
+        t = time.perf_counter()
+        data = self.fobj.read(size)
+        self.telemetry.add(self.stage, time.perf_counter() - t, len(data))
+        self.telemetry.progress()
+        return data
+
+    def readline(self, size=-1):
+        t = time.perf_counter()
+        line = self.fobj.readline(size)
+        self.telemetry.add(self.stage, time.perf_counter() - t, len(line))
+        self.lines += 1
+        if not self.lines & 4095:
+            self.telemetry.lines += 4096
+            self.telemetry.progress()
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def write(self, data):
+        t = time.perf_counter()
+        n = self.fobj.write(data)
+        self.telemetry.add(self.stage, time.perf_counter() - t, len(data))
+        return n
+
+    def flush(self):
+        self.fobj.flush()
+
+    def close(self):
+        self.fobj.close()
+
+
+class Telemetry:
+    def __init__(self, outfile="-", interval=10.0, command=None):
+        self.opf = sys.stderr if outfile == "-" else open(outfile, "a")
+        self.interval = interval
+        self.command = command
+        self.started = self.last = time.perf_counter()
+        self.timers = {}
+        self.bytes = {}
+        self.inputs = []
+        self.size = 0
+        self.lines = 0
+        self.done = 0
+        self.position = None
+        self.extra = {}
+
+    def add(self, stage, seconds, nbytes=0):
+        self.timers[stage] = self.timers.get(stage, 0.0) + seconds
+        self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+
+    def record(self, **fields):
+        self.extra.update(fields)
+
+    def emit(self, event, **fields):
+        rec = {"event": event, "command": self.command, "time": time.time(), "elapsed": time.perf_counter() - self.started}
+        rec.update(fields)
+        self.opf.write(json.dumps(rec, default=str) + "\n")
+        self.opf.flush()
+
+    def meter(self, infiter):
+        for i, line in enumerate(infiter, 1):
+            if not i & 4095:
+                self.lines, self.position = i, line
+                self.progress()
+            yield line
+
+    def wrap_input(self, fobj, infile):
+        if infile != "-" and os.path.isfile(infile):
+            self.size += os.path.getsize(infile)
+        self.inputs.append(fobj)
+        return Metered(fobj, self)
+
+    def wrap_output(self, fobj):
+        return Metered(fobj, self, "write")
+
+    def consumed(self):
+        done = self.done
+        for fobj in self.inputs:
+            counts = input_counts(fobj)
+            done += counts["inbytes"] if counts else fobj.tell() if fobj.seekable() else 0
+        return done
+
+    def progress(self, force=False):
+        now = time.perf_counter()
+        if not force and (not self.interval or now - self.last < self.interval):
+            return
+        self.last = now
+        elapsed = now - self.started
+        done = self.consumed() if self.size else 0
+        rate = done / elapsed if elapsed else 0
+        position = self.position
+        if isinstance(position, bytes):
+            position = position.split(None, 1)[0].partition(b")")[0].decode(errors="replace") if position.strip() else None
+        self.emit("progress", lines=self.lines, bytes=self.bytes.get("read", 0), lines_per_sec=self.lines / elapsed, bytes_per_sec=self.bytes.get("read", 0) / elapsed,
+                  host=position, input_done=done, input_size=self.size or None, eta_seconds=(self.size - done) / rate if rate else None)
+
+    def stages(self):
+        stages = {k: round(v, 6) for k, v in self.timers.items()}
+        decode = wait = 0.0
+        for fobj in self.inputs:
+            counts = input_counts(fobj)
+            if counts:
+                decode += counts["decode_seconds"]
+                wait += counts["wait_seconds"]
+        if decode:
+            stages["decompress"] = round(decode, 6)
+            stages["decompress_wait"] = round(wait, 6)
+        stages["process"] = round(time.perf_counter() - self.started - sum(self.timers.values()), 6)
+        return stages
+
+    def finish(self, counts=None):
+        self.emit("done", counts=counts, stages=self.stages(), bytes=self.bytes, **self.extra)
+        if self.opf is not sys.stderr:
+            self.opf.close()
+
+
+@contextlib.contextmanager
+def profiled(kind=None, outfile=None, telemetry=None):
+    if not kind:
+        yield
+        return
+    if kind == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(outfile or "mementomap.prof")
+        return
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = [{"site": str(stat.traceback[0]), "size": stat.size, "count": stat.count} for stat in snapshot.statistics("lineno")[:20]]
+        if telemetry:
+            telemetry.record(memory={"current": current, "peak": peak, "top": top})
+        else:
+            with open(outfile or "mementomap.malloc.json", "w") as f:
+                json.dump({"current": current, "peak": peak, "top": top}, f, indent=2)
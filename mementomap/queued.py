@@ -0,0 +1,55 @@
+import io
+import queue
+import threading
+import time
+
+
+class QueuedReader(io.RawIOBase):
+    # Raw reader over chunks that a background thread running _produce puts on a bounded queue
+    def __init__(self, counts, queue_size=16):
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.chunk = memoryview(b"")
+        self.done = False
+        self.counts = dict(counts, wait_seconds=0.0)
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def _produce(self):
+        raise NotImplementedError
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readinto(self, b):
+        while not self.chunk:
+            if self.done:
+                return 0
+            t = time.perf_counter()
+            item = self.queue.get()
+            self.counts["wait_seconds"] += time.perf_counter() - t
+            if item is None:
+                self.done = True
+                return 0
+            if isinstance(item, Exception):
+                self.done = True
+                raise item
+            self.chunk = memoryview(item)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+        super().close()
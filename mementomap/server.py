@@ -0,0 +1,186 @@
+import asyncio
+import bisect
+import json
+import os
+import sys
+import time
+
+from urllib.parse import parse_qs, urlsplit
+
+from mementomap import __VERSION__
+from mementomap.cli import MementoMapReader, parse_named_path
+
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000]
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def _file_id(mmapfile):
+    ids = []
+    for path in [mmapfile, f"{mmapfile}.idx", f"{mmapfile}.bloom"]:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if path is mmapfile:
+                raise
+            st = None
+        ids.append(st and (st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(ids)
+
+
+class ServedMap:
+    def __init__(self, name, mmapfile, cache_size=4096):
+        self.name = name
+        self.mmapfile = mmapfile
+        self.cache_size = cache_size
+        self.fileid = _file_id(mmapfile)
+        self.reader = MementoMapReader.open_with_fallback(mmapfile, cache_size)
+        self.loaded = time.time()
+        self.counts = {"requests": 0, "lookups": 0, "found": 0, "errors": 0, "reloads": 0}
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def reload(self):
+        try:
+            fileid = _file_id(self.mmapfile)
+            if fileid == self.fileid:
+                return False
+            reader = MementoMapReader.open_with_fallback(self.mmapfile, self.cache_size)
+        except (OSError, ValueError) as e:
+            print(f"Cannot reload {self.mmapfile}: {e}", file=sys.stderr)
+            return False
+        self.reader, old = reader, self.reader
+        self.fileid = fileid
+        self.loaded = time.time()
+        self.counts["reloads"] += 1
+        old.close()
+        return True
+
+    def lookup(self, surt):
+        t = time.perf_counter()
+        try:
+            res = self.reader.lookup(surt)
+        except Exception as e:
+            self.counts["errors"] += 1
+            res = None
+        self.histogram[bisect.bisect_left(BUCKETS, (time.perf_counter() - t) * 1000)] += 1
+        self.counts["lookups"] += 1
+        if res:
+            self.counts["found"] += 1
+        return res
+
+    def stats(self):
+        latency = {str(b): n for b, n in zip(BUCKETS, self.histogram)}
+        latency["+Inf"] = self.histogram[-1]
+        return dict(self.counts, path=self.mmapfile, loaded=self.loaded, cache=self.reader.stats(), latency_ms=latency)
+
+    def close(self):
+        self.reader.close()
+
+
+class MementoMapServer:
+    def __init__(self, mmaps, cache_size=4096, reload_interval=2.0, max_body=64 << 20):
+        self.maps = {}
+        for spec in mmaps:
+            name, mmapfile = parse_named_path(spec)
+            if name in self.maps:
+                raise ValueError(f"Duplicate MementoMap name {name}")
+            self.maps[name] = ServedMap(name, mmapfile, cache_size)
+        self.reload_interval = reload_interval
+        self.max_body = max_body
+        self.started = time.time()
+
+    def _select(self, query):
+        names = query.get("map") or list(self.maps)
+        missing = [name for name in names if name not in self.maps]
+        if missing:
+            raise KeyError(f"Unknown MementoMap {', '.join(missing)}")
+        return [self.maps[name] for name in names]
+
+    def handle(self, method, target, body):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        try:
+            if url.path == "/lookup":
+                if method != "GET":
+                    return 405, {"error": "Use GET for /lookup"}
+                if "surt" not in query:
+                    return 400, {"error": "Missing surt parameter"}
+                res = {}
+                for mm in self._select(query):
+                    mm.counts["requests"] += 1
+                    res[mm.name] = mm.lookup(query["surt"][0])
+                return 200, res
+            if url.path == "/batchlookup":
+                if method != "POST":
+                    return 405, {"error": "Use POST for /batchlookup"}
+                surts = [line.strip() for line in body.decode().splitlines() if line.strip()]
+                res = {}
+                for mm in self._select(query):
+                    mm.counts["requests"] += 1
+                    res[mm.name] = [mm.lookup(surt) for surt in surts]
+                return 200, res
+            if url.path == "/stats":
+                return 200, {"version": __VERSION__, "uptime": time.time() - self.started, "maps": {name: mm.stats() for name, mm in self.maps.items()}}
+        except KeyError as e:
+            return 404, {"error": e.args[0]}
+        except UnicodeDecodeError as e:
+            return 400, {"error": "Request body is not UTF-8"}
+        return 404, {"error": f"No such endpoint {url.path}"}
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request.strip():
+                    break
+                method, target, version = (request.decode("latin-1").split() + ["", ""])[:3]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > self.max_body:
+                    status, res = 413, {"error": f"Request body larger than {self.max_body} bytes"}
+                    keepalive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, res = self.handle(method, target, body)
+                    keepalive = headers.get("connection", "").lower() != "close" if version == "HTTP/1.1" else headers.get("connection", "").lower() == "keep-alive"
+                payload = json.dumps(res).encode()
+                writer.write(f"{version or 'HTTP/1.0'} {status} {REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: {'keep-alive' if keepalive else 'close'}\r\n\r\n".encode() + payload)
+                await writer.drain()
+                if not keepalive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            pass
+        finally:
+            writer.close()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            for mm in self.maps.values():
+                if mm.reload():
+                    print(f"Reloaded {mm.name} from {mm.mmapfile}", file=sys.stderr)
+
+    def serve(self, host="127.0.0.1", port=8080):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self._serve_client, host, port))
+        watcher = loop.create_task(self._watch()) if self.reload_interval > 0 else None
+        print(f"Serving {', '.join(self.maps)} on http://{host}:{port}/", file=sys.stderr)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if watcher:
+                watcher.cancel()
+                loop.run_until_complete(asyncio.gather(watcher, return_exceptions=True))
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+            for mm in self.maps.values():
+                mm.close()
@@ -1,55 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import fileinput
+import functools
+import itertools
 import json
 import os
-import re
 import sys
-import time
-
-matchers = {
-    "clog": re.compile(r'^(?P<host>\S+)\s+(?P<identity>\S+)\s+(?P<user>\S+)\s+\[(?P<origtime>.+?)\]\s+"(?P<request>.*?)"\s+(?P<status>\S+)\s+(?P<size>\S+)(\s+"(?P<referrer>.*?)"\s+"(?P<agent>.*?)"\s*(?P<extras>.*?))?\s*$'),
-    "hreq": re.compile(r'^(?P<method>[A-Z]+)\s+([hH][tT]{2}[pP][sS]?://[\w\-\.]+(:\d+)?)?(?P<path>\S+)\s+(?P<httpv>HTTP\/\d(\.\d)?)$'),
-    "urim": re.compile(r'^(?P<prefix>[\w\-\/]*?\/)(?P<mtime>\d{14})((?P<rflag>[a-z]{2}_))?\/(?P<urir>\S+)$')
-}
-
-validators = {
-    "host": re.compile(r'^((25[0-5]|(2[0-4]|1\d?|[2-9])?\d)(\.(25[0-5]|(2[0-4]|1\d?|[2-9])?\d)){3})|([\da-fA-F]{0,4}:){2,7}[\da-fA-F]{0,4}$'),
-    "request": re.compile(r'^[A-Z]+\s+\S+\s+HTTP\/\d(\.\d)?$'),
-    "status": re.compile(r'^[1-5]\d{2}$'),
-    "size": re.compile(r'^\-|\d+$'),
-    "referrer": re.compile(r'^(https?://[\w\-\.]+(:\d+)?(/(\S)*)?)?$', re.I)
-}
-
-origtime_format = "%d/%b/%Y:%H:%M:%S %z"
+
+from concurrent.futures import ProcessPoolExecutor
+
+if not __package__:
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from mementomap.commonlog import formatting_fields, origtime_format, parse_field_match, parse_record, validators
+
 output_format = '{host} {date} {time} {method} {path} {status} {size} "{referrer}" "{agent}"'
 icount = ocount = 0
-
-formatting_fields = {
-    "origline": "Original log line",
-    "host": "IP address of the client",
-    "identity": "Identity of the client, usually '-'",
-    "user": "User ID for authentication, usually '-'",
-    "origtime": "Original date and time (typically in '%d/%b/%Y:%H:%M:%S %z' format)",
-    "epoch": "Seconds from the Unix epoch (derived from origtime)",
-    "date": "UTC date in '%Y-%m-%d' format (derived from origtime)",
-    "time": "UTC time in '%H:%M:%S' format (derived from origtime)",
-    "datetime": "14 digit datetime in '%Y%m%d%H%M%S' format (derived from origtime)",
-    "request": "Original HTTP request line",
-    "method": "HTTP method (empty for invalid request)",
-    "path": "Path and query (scheme and host removed, empty for invalid request)",
-    "prefix": "Memento endpoint path prefix (derived from path)",
-    "mtime": "14 digit Memento datetime (derived from path)",
-    "rflag": "Memento rewrite flag (derived from path)",
-    "urir": "Memento URI-R (derived from path)",
-    "httpv": "HTTP version (empty for invalid request)",
-    "status": "Returned status code",
-    "size": "Number of bytes returned",
-    "referrer": "Referer header (empty, if not logged)",
-    "agent": "User-agent header (empty, if not logged)",
-    "extras": "Any additional logged fields"
-}
+worker_args = None
 
 
 def print_fields():
@@ -65,58 +34,52 @@ def print_summary(**kw):
     print(f"PROCESSED: {icount}, PRODUCED: {ocount}, SKIPPED: {icount - ocount}", **kw)
 
 
-def string_output(record, template, **kw):
-    print(template.format_map({k: v or "-" for k, v in record.items()}), **kw)
-
-
-def json_output(record, template, **kw):
-    print(json.dumps({fld: record[fld] for fld in template}), **kw)
-
-
-def parse_record(line, non_empty_fields=[], validate_fields=[], field_matches=[], origtime_format="%d/%b/%Y:%H:%M:%S %z"):
-    m = matchers["clog"].match(line)
-    if not m:
-        raise ValueError("Malformed record")
+def string_output(record, template):
+    return template.format_map({k: v or "-" for k, v in record.items()})
 
-    record = {fld: "" for fld in formatting_fields}
-    record["origline"] = line
-    record.update(m.groupdict(default=""))
 
-    for fld in validate_fields:
-        reg = validators.get(fld)
-        val = record.get(fld, "")
-        if reg and not reg.match(val):
-            raise ValueError(f"Invalid field {fld}: {val}")
+def json_output(record, template):
+    return json.dumps({fld: record[fld] for fld in template})
 
-    try:
-        et = time.mktime(time.strptime(record["origtime"], origtime_format))
-        record["epoch"] = int(et)
-        ut = time.gmtime(et)
-        record["date"] = time.strftime("%Y-%m-%d", ut)
-        record["time"] = time.strftime("%H:%M:%S", ut)
-        record["datetime"] = time.strftime("%Y%m%d%H%M%S", ut)
-    except Exception as e:
-        raise ValueError(f"Invalid time: {record['origtime']}")
-
-    m = matchers["hreq"].match(record["request"])
-    if m:
-        record.update(m.groupdict(default=""))
-
-    m = matchers["urim"].match(record["path"])
-    if m:
-        record.update(m.groupdict(default=""))
 
-    for fld in non_empty_fields:
-        if record.get(fld, "") in ["", "-"]:
-            raise ValueError(f"Empty field: {fld}")
+def init_worker(*args):
+    global worker_args
+    worker_args = args
 
-    for (fld, reg) in field_matches:
-        val = record.get(fld, "")
-        m = reg.search(val)
-        if not m:
-            raise ValueError(f"Mismatch field {fld}: {val}")
 
-    return record
+def process_lines(lines):
+    parse_opts, output_formatter, debug = worker_args
+    out = []
+    skipped = []
+    for line in lines:
+        try:
+            line = line.decode().strip()
+            record = parse_record(line, **parse_opts)
+            out.append(output_formatter(record))
+        except Exception as e:
+            if debug:
+                skipped.append(f"SKIPPING [{e}]: {line}")
+    out.append("")
+    return "\n".join(out) if len(out) > 1 else "", len(lines), len(out) - 1, skipped
+
+
+def process_batches(batches, workers=1):
+    if workers == 1:
+        yield from map(process_lines, batches)
+        return
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=worker_args) as executor:
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(executor.submit(process_lines, batch))
+                if len(pending) >= 4 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 if __name__ == "__main__":
@@ -128,6 +91,8 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--origtime-format", metavar="TFORMAT", default=origtime_format, help=f"Original datetime format of logs (default: '{origtime_format.replace('%', '%%')}')")
     parser.add_argument("-f", "--format", default=output_format, help="Output format string (see available formatting fields below)")
     parser.add_argument("-j", "--json", metavar="JFIELDS", default=[], type=lambda flds: [f.strip() for f in flds.split(",") if f], help="Output NDJSON with the provided fields (use 'all' for all fields except 'origline')")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=1, help="Number of parsing processes, 0 for all cores (default: 1)")
+    parser.add_argument("-b", "--batch-size", metavar="LINES", type=int, default=10_000, help="Number of lines parsed and written per batch (default: 10000)")
     parser.add_argument("files", nargs="*", help="Log files (plain/gz/bz2) to parse (reads from the STDIN, if empty or '-')")
     args = parser.parse_args()
 
@@ -138,14 +103,10 @@ if __name__ == "__main__":
 
     field_matches = []
     for am in args.match_field:
-        fm = am.split("~", 1)
-        if len(fm) != 2 or fm[0] not in formatting_fields.keys() or not fm[1]:
-            sys.exit(f"'{am}' is not a valid field match option (use 'FIELD~RegEg' instead)")
         try:
-            reg = re.compile(fm[1])
-            field_matches.append((fm[0], reg))
-        except Exception as e:
-            sys.exit(f"'{fm[1]}' is not a valid Regular Expression")
+            field_matches.append(parse_field_match(am))
+        except ValueError as e:
+            sys.exit(e)
 
     if args.validate_fields == ["all"]:
         args.validate_fields = validators.keys()
@@ -153,32 +114,32 @@ if __name__ == "__main__":
         if vf not in validators.keys():
             sys.exit(f"'{vf}' field does not have a builtin validation, only '{','.join(validators.keys())}' do")
 
-    output_formatter = lambda record, **kw: string_output(record, args.format.replace("\\t", "\t"), **kw)
+    output_formatter = functools.partial(string_output, template=args.format.replace("\\t", "\t"))
     if args.json:
         if args.json == ["all"]:
-            args.json = formatting_fields.keys() - "origline"
-        output_formatter = lambda record, **kw: json_output(record, args.json, **kw)
+            args.json = [fld for fld in formatting_fields if fld != "origline"]
+        output_formatter = functools.partial(json_output, template=args.json)
     try:
-        output_formatter({fld: "" for fld in formatting_fields}, file=open(os.devnull, "w"))
+        output_formatter({fld: "" for fld in formatting_fields})
     except KeyError as e:
         sys.exit(f"{e} is not a valid formatting field")
     except ValueError as e:
         sys.exit(e)
 
+    parse_opts = {"non_empty_fields": args.non_empty_fields, "validate_fields": list(args.validate_fields), "field_matches": field_matches, "origtime_format": args.origtime_format}
+    init_worker(parse_opts, output_formatter, args.debug)
+    lines = fileinput.input(files=args.files, mode="rb", openhook=fileinput.hook_compressed)
+    batches = iter(lambda: list(itertools.islice(lines, args.batch_size)), [])
+
     try:
-        for line in fileinput.input(files=args.files, mode="rb", openhook=fileinput.hook_compressed):
-            if not icount % 1_000 and icount:
-                print_summary(file=debuglog)
-
-            try:
-                icount += 1
-                line = line.decode().strip()
-                record = parse_record(line, non_empty_fields=args.non_empty_fields, validate_fields=args.validate_fields, field_matches=field_matches, origtime_format=args.origtime_format)
-                output_formatter(record)
-                ocount += 1
-            except Exception as e:
-                print(f"SKIPPING [{e}]: {line}", file=debuglog)
-        print_summary(file=debuglog)
+        for out, processed, produced, skipped in process_batches(batches, args.workers):
+            sys.stdout.write(out)
+            icount += processed
+            ocount += produced
+            for msg in skipped:
+                print(msg, file=debuglog)
+            print_summary(file=debuglog)
+        sys.stdout.flush()
     except (BrokenPipeError, KeyboardInterrupt) as e:
         print_summary(file=debuglog)
         sys.exit()
@@ -0,0 +1,106 @@
+import io
+import json
+import os
+import random
+
+import pytest
+
+from mementomap.binary import CODECS, BinaryMap, write_binary, zstandard
+from mementomap.cli import MementoMapReader, bin_search, convert, lookup
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    MMAPS = [os.path.join(DATA, case["outfile"]) for case in json.load(f)]
+NEEDS_ZSTD = pytest.mark.skipif(not zstandard, reason="needs zstandard")
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def prepare(mmapfile, tmp_path):
+    # Compacted fixtures are not strictly sorted and can repeat a key, keep the first line of each key in byte order
+    lines = {}
+    with open(mmapfile, "rb") as f:
+        for line in f:
+            lines.setdefault(line.split()[0], line)
+    outfile = str(tmp_path / os.path.basename(mmapfile))
+    with open(outfile, "wb") as opf:
+        opf.writelines(lines[key] for key in sorted(lines))
+    return outfile
+
+
+def ukvs(r, n):
+    values = [b"0", b"1", b"127", b"128", b"%d" % (1 << 40), b"007", b"-3", b"1.5", b"ia,loc", b"a" * 200]
+    keys = sorted({b"com,%s)/%s" % (r.choice([b"a", b"ab", b"b,www"]), b"/".join(b"%d" % r.randrange(30) for _ in range(r.randrange(4)))) for _ in range(n)})
+    return [b"%s %s\n" % (key, r.choice(values) if r.random() < 0.3 else b"%d" % r.randrange(1000)) for key in keys]
+
+
+@pytest.mark.parametrize("codec", [c if c != "zstd" else pytest.param(c, marks=NEEDS_ZSTD) for c in CODECS])
+@pytest.mark.parametrize("blocksize", [1, 64, 4096])
+def test_roundtrip(codec, blocksize):
+    lines = ukvs(random.Random(blocksize), 2000)
+    headers = [b"!meta {\"name\": \"test\"}\n", b"!context [\"http://tools.ietf.org/html/rfc7089\"]\r\n"]
+    opf = io.BytesIO()
+    counts = write_binary(headers[:1] + lines + headers[1:], opf, blocksize, codec)
+    assert counts["inlines"] == len(lines) + 2 and counts["outlines"] == len(lines) + 2
+    assert counts["outbytes"] == len(opf.getvalue())
+    binary = BinaryMap(opf.getvalue())
+    assert counts["blocks"] == len(binary.blocks) and (blocksize > 1 or len(binary.blocks) == len(lines))
+    assert list(binary.lines()) == [line.rstrip(b"\r\n") + b"\n" for line in headers] + lines
+    assert [list(entry) for entry in binary.entries()] == [line.split() for line in lines]
+    entries = dict(line.split() for line in lines)
+    for key, value in entries.items():
+        assert binary.search(key) == [key, value]
+        if key + b"~" not in entries:
+            assert binary.search(key + b"~") is None
+    assert binary.search(b"aaa") is None and binary.search(b"zzz") is None
+
+
+@pytest.mark.skipif(bool(zstandard), reason="zstandard is installed")
+def test_zstd_missing():
+    with pytest.raises(ValueError, match="zstandard"):
+        write_binary([b"com,a)/ 1\n"], io.BytesIO(), codec="zstd")
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError, match="Unknown codec"):
+        write_binary([b"com,a)/ 1\n"], io.BytesIO(), codec="bz2")
+
+
+@pytest.mark.parametrize("codec", [c if c != "zstd" else pytest.param(c, marks=NEEDS_ZSTD) for c in CODECS])
+def test_convert_roundtrip(tmp_path, codec):
+    infile = str(tmp_path / "in.ukvs")
+    with open(infile, "wb") as f:
+        f.write(b"!meta a\n")
+        f.writelines(ukvs(random.Random(1), 500))
+    binfile, outfile = str(tmp_path / "out.bin"), str(tmp_path / "out.ukvs")
+    counts = convert(infile, binfile, blocksize=1, codec=codec)
+    assert counts["outbytes"] == os.path.getsize(binfile)
+    assert convert(binfile, outfile)["outlines"] == counts["outlines"]
+    assert read(outfile) == read(infile)
+    with pytest.raises(ValueError, match="GZipped"):
+        convert(infile, str(tmp_path / "out.bin.gz"))
+
+
+@pytest.mark.parametrize("mmapfile", MMAPS, ids=os.path.basename)
+@pytest.mark.parametrize("codec", ["none", "zlib"])
+def test_binary_matches_text(tmp_path, mmapfile, codec):
+    textfile = prepare(mmapfile, tmp_path)
+    binfile = str(tmp_path / "map.bin")
+    convert(textfile, binfile, blocksize=1, codec=codec)
+    with open(textfile, "rb") as f:
+        lines = f.readlines()
+        keys = [line.split()[0] for line in lines]
+        with open(binfile, "rb") as b:
+            binary = BinaryMap(b.read())
+        assert [b"%s %s\n" % entry for entry in binary.entries()] == lines
+        for key in keys + [key[:-1] for key in keys] + [key + b"/a" for key in keys]:
+            assert binary.search(key) == bin_search(f, key)
+        surts = [key.decode().rstrip("*") + suffix for key in keys for suffix in ["", "/x", "?q=1"]] + ["zzz,a)/"]
+        expected = [lookup(f, surt) for surt in surts]
+    assert any(expected) and not all(expected)
+    with MementoMapReader(binfile) as reader:
+        assert reader.binary
+        assert [lookup(reader, surt) for surt in surts] == expected
@@ -0,0 +1,121 @@
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from mementomap.cli import generate
+from mementomap.inputs import input_counts, open_input
+
+PAGE_SIZE = 40
+
+
+def cdx_lines():
+    lines = []
+    for host in ["com,example)", "com,example,www)", "org,archive)", "org,example,blog)"]:
+        for i in range(60):
+            for ts in ["20200101000000", "20210101000000"]:
+                path = f"/section{i % 7}/page{i}"
+                lines.append(f"{host}{path} {ts} http://example/{path} text/html 200 SHA1 - - 512 {i} file.warc.gz\n".encode())
+    return sorted(lines)
+
+
+class CDXServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, lines, pages_as="json", failures=0):
+        super().__init__(("127.0.0.1", 0), CDXHandler)
+        self.pages = [lines[i:i + PAGE_SIZE] for i in range(0, len(lines), PAGE_SIZE)]
+        self.pages_as = pages_as
+        self.failures = failures
+        self.requests = []
+
+
+class CDXHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        self.server.requests.append(query)
+        if "showNumPages" in query:
+            count = len(self.server.pages)
+            body = json.dumps({"pages": count, "pageSize": PAGE_SIZE, "blocks": count}) if self.server.pages_as == "json" else str(count)
+            return self.reply(200, body.encode())
+        if self.server.failures:
+            self.server.failures -= 1
+            return self.reply(503, b"")
+        lines = self.server.pages[int(query["page"][0])]
+        if query.get("fl") == ["urlkey"]:
+            lines = [line.split(b" ", 1)[0] + b"\n" for line in lines]
+        self.reply(200, b"".join(lines))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(*args, **kw):
+    server = CDXServer(*args, **kw)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def cdxfile(tmp_path):
+    path = tmp_path / "input.cdx"
+    path.write_bytes(b"".join(cdx_lines()))
+    return str(path)
+
+
+def generate_from(infile, outfile, **kw):
+    fobj = open_input(infile, **kw)
+    res = generate(fobj, outfile)
+    counts = input_counts(fobj)
+    fobj.close()
+    with open(outfile, "rb") as f:
+        return f.read(), res, counts
+
+
+@pytest.mark.parametrize("pages_as", ["json", "int"])
+def test_generate_from_api(cdxfile, tmp_path, pages_as):
+    server = serve(cdx_lines(), pages_as)
+    try:
+        remote, res, counts = generate_from(f"http://127.0.0.1:{server.server_port}/cdx?url=*.example", str(tmp_path / "remote.ukvs"), concurrency=3)
+    finally:
+        server.shutdown()
+        server.server_close()
+    local, expected, _ = generate_from(cdxfile, str(tmp_path / "local.ukvs"))
+    assert remote == local
+    assert res["outlines"] == expected["outlines"]
+    assert counts["pages"] == len(server.pages) > 1
+    assert counts["connections"] <= 3
+    assert all(query["fl"] == ["urlkey"] and query["url"] == ["*.example"] for query in server.requests)
+    assert sorted(int(query["page"][0]) for query in server.requests if "page" in query) == list(range(len(server.pages)))
+
+
+def test_retry(cdxfile, tmp_path):
+    server = serve(cdx_lines(), failures=2)
+    try:
+        remote, res, counts = generate_from(f"http://127.0.0.1:{server.server_port}/cdx?url=*.example", str(tmp_path / "remote.ukvs"), concurrency=1, retries=2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert remote == generate_from(cdxfile, str(tmp_path / "local.ukvs"))[0]
+    assert counts["retries"] == 2
+
+
+def test_retries_exhausted(tmp_path):
+    server = serve(cdx_lines(), failures=10)
+    try:
+        with pytest.raises(ConnectionError, match="status 503"):
+            generate_from(f"http://127.0.0.1:{server.server_port}/cdx", str(tmp_path / "remote.ukvs"), concurrency=1, retries=1)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,89 @@
+import gzip
+import io
+import json
+import os
+import random
+
+import pytest
+
+from mementomap.cli import Compactor, RollupWriter, compact, generate
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    CASES = json.load(f)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def run(case, outfile):
+    with open(os.path.join(DATA, case["infile"]), "rb") as f:
+        return (generate if case["infile"].endswith(".cdx") else compact)(f, outfile, **case["params"])
+
+
+class Stream:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: case["outfile"])
+def test_stream_output(tmp_path, capsysbinary, case):
+    expected = read(os.path.join(DATA, case["outfile"]))
+    stream = Stream()
+    assert run(case, stream) == case["counts"]
+    assert bytes(stream.data) == expected
+    assert run(case, str(tmp_path / "out.gz")) == case["counts"]
+    assert gzip.decompress(read(str(tmp_path / "out.gz"))) == expected
+    assert run(case, "-") == case["counts"]
+    assert capsysbinary.readouterr().out == expected
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: case["outfile"])
+def test_engine_feeds(case):
+    data = read(os.path.join(DATA, case["infile"]))
+    lines = data.splitlines(True)
+    r = random.Random(len(lines))
+    cuts = sorted(r.sample(range(1, len(lines)), 5))
+    stream = Stream()
+    engine = Compactor(stream, cdx=case["infile"].endswith(".cdx"), **case["params"])
+    for start, end in zip([0] + cuts, cuts + [len(lines)]):
+        engine.feed(lines[start:end] if start % 2 else io.BytesIO(b"".join(lines[start:end])))
+    assert engine.close() == case["counts"]
+    assert bytes(stream.data) == read(os.path.join(DATA, case["outfile"]))
+    assert sum(engine.hrollups) + sum(engine.prollups) == case["counts"]["rollups"]
+
+
+def test_rollup_writer_spill():
+    r = random.Random(7)
+    stream = Stream()
+    writer = RollupWriter(stream, bufsize=64)
+    expected = io.BytesIO()
+    flushed = 0
+    for _ in range(2000):
+        op = r.random()
+        if op < 0.6:
+            data = bytes(r.randrange(97, 123) for _ in range(r.randrange(1, 40)))
+            writer.write(data)
+            expected.write(data)
+        elif op < 0.9:
+            pos = r.randrange(flushed, writer.tell() + 1)
+            writer.seek(pos)
+            expected.seek(pos)
+            expected.truncate()
+        else:
+            flushed = r.randrange(flushed, writer.tell() + 1)
+            writer.flush(flushed)
+            flushed = writer.base
+        assert writer.tell() == expected.tell()
+    assert writer.spill
+    assert writer.close() == len(expected.getvalue())
+    assert bytes(stream.data) == expected.getvalue()
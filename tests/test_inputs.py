@@ -0,0 +1,43 @@
+import bz2
+import gzip
+import io
+import random
+
+import pytest
+
+from mementomap.inputs import CODECS, PipelinedReader, _find_member
+
+
+def members(r, sizes, compress):
+    data, raw = bytearray(), bytearray()
+    for size in sizes:
+        part = b"".join(b"com,a%d)/%d %d\n" % (r.randrange(100), r.randrange(10 ** 6), r.randrange(9)) for _ in range(size))
+        raw += part
+        data += compress(part)
+    return bytes(data), bytes(raw)
+
+
+@pytest.mark.parametrize("ext, compress", [(".gz", gzip.compress), (".bz2", bz2.compress)])
+@pytest.mark.parametrize("sizes", [[5000], [3000, 200000], [40000] * 6, [1] * 50])
+def test_parallel_decode(tmp_path, ext, compress, sizes):
+    data, raw = members(random.Random(len(sizes)), sizes, compress)
+    infile = str(tmp_path / f"input{ext}")
+    with open(infile, "wb") as f:
+        f.write(data)
+    for workers in [1, 4]:
+        with PipelinedReader(infile, workers=workers, blocksize=1 << 16, segsize=1 << 16) as reader:
+            assert io.BufferedReader(reader).read() == raw
+            assert reader.parallel == (workers > 1 and len(sizes) > 1)
+
+
+def test_find_member_stops_at_end():
+    data = b"x" * 100 + gzip.compress(b"a") + b"y" * 1000 + gzip.compress(b"b")
+    pattern = CODECS[".gz"][0]
+    second = data.rindex(b"\x1f\x8b")
+    f = io.BytesIO(data)
+    assert _find_member(f, pattern, 0, blocksize=16) == 100
+    assert _find_member(f, pattern, 101, blocksize=16) == second
+    assert _find_member(f, pattern, 101, 600, blocksize=16) is None
+    assert f.tell() <= 600 + 15
+    assert _find_member(f, pattern, 101, second + 1, blocksize=16) == second
+    assert _find_member(f, pattern, 101, second, blocksize=16) is None
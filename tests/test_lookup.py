@@ -0,0 +1,71 @@
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from mementomap.cli import MementoMapReader, lookup, sorted_lookup
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    MMAPS = [os.path.join(DATA, case["outfile"]) for case in json.load(f)]
+
+
+def prepare(mmapfile, tmp_path):
+    # Compacted fixtures are not strictly sorted and can repeat a key, keep the first line of each key in byte order
+    lines = {}
+    with open(mmapfile, "rb") as f:
+        for line in f:
+            lines.setdefault(line.split()[0], line)
+    outfile = str(tmp_path / os.path.basename(mmapfile))
+    with open(outfile, "wb") as opf:
+        opf.writelines(lines[key] for key in sorted(lines))
+    return outfile
+
+
+def probes(mmapfile):
+    surts = {"aaa,b)/", "zzz,a)/", "com,cnn)/news/a"}
+    with open(mmapfile, "rb") as f:
+        for line in f:
+            key = line.split()[0].decode()
+            base = key.rstrip("*").rstrip("/,")
+            host = base.split(")")[0]
+            surts.update([key, base, base + "/", base + "?x=1", base + "/a/b", base + "-x", base + "/%7E", host + ")/", host + ",www)/z"])
+    return sorted(surts, key=str.encode)
+
+
+@pytest.mark.parametrize("mmapfile", MMAPS, ids=os.path.basename)
+@pytest.mark.parametrize("lookahead", [1, 4096])
+def test_sorted_lookup(tmp_path, mmapfile, lookahead):
+    mmapfile = prepare(mmapfile, tmp_path)
+    surts = probes(mmapfile)
+    with open(mmapfile, "rb") as f:
+        expected = [lookup(f, surt) for surt in surts]
+    assert any(expected) and not all(expected)
+    with open(mmapfile, "rb") as f:
+        assert list(sorted_lookup(f, surts, lookahead=lookahead)) == expected
+    with MementoMapReader(mmapfile) as reader:
+        assert list(sorted_lookup(reader, surts, lookahead=lookahead)) == expected
+        assert sum(reader.distances.values()) == len(surts)
+
+
+def test_sorted_lookup_unsorted():
+    with open(MMAPS[0], "rb") as f:
+        with pytest.raises(ValueError, match="not sorted"):
+            list(sorted_lookup(f, ["org,b)/", "com,a)/"]))
+
+
+def test_sorted_lookup_memory(tmp_path):
+    mmapfile = str(tmp_path / "big.ukvs")
+    with open(mmapfile, "w") as f:
+        f.write("com,a)/ 1\n")
+        f.writelines(f"com,big)/p{i:06d} 1\n" for i in range(50000))
+        f.write("com,big,* 5\norg,z)/ 1\n")
+    surts = ["com,big)/a", "com,big)/p000005", "com,big)/zz", "org,z)/x"]
+    tracemalloc.start()
+    with open(mmapfile, "rb") as f:
+        res = list(sorted_lookup(f, surts, lookahead=64))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert [hit and hit["surtk"] for hit in res] == ["com,big,*", "com,big)/p000005", "com,big,*", None]
+    assert peak < 1 << 20
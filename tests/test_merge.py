@@ -0,0 +1,76 @@
+import collections
+import random
+
+import pytest
+
+from mementomap.cli import merge_iter
+
+
+def covers(wkey, key):
+    base = wkey[:-2]
+    if wkey.endswith(b"/*"):
+        return key == base or key.startswith(base + b"/")
+    return key.startswith(base + b")") or key.startswith(base + b",")
+
+
+def reference(streams):
+    # Sum all frequencies, then move each key into the outermost wildcard covering it
+    totals = collections.Counter()
+    for stream in streams:
+        for line in stream:
+            key, freq = line.split()
+            totals[key] += int(freq)
+    wildcards = [key for key in totals if key.endswith((b"/*", b",*"))]
+    merged = collections.Counter()
+    for key, freq in totals.items():
+        around = [wkey for wkey in wildcards if wkey != key and covers(wkey, key)]
+        outer = [wkey for wkey in around if not any(other != wkey and covers(other, wkey) for other in around)]
+        merged[outer[0] if outer else key] += freq
+    return [b"%s %d\n" % (key, merged[key]) for key in sorted(merged)]
+
+
+def random_keys(r):
+    hosts = [b"com,cnn", b"com,cnn,www", b"com,a", b"org,cnn"]
+    segments = [b"%7e", b"$", b"a", b"news", b"b", b"a-b"]
+    keys = set()
+    for _ in range(r.randrange(1, 12)):
+        host = r.choice(hosts)
+        c = r.random()
+        if c < 0.08:
+            keys.add(host.rsplit(b",", 1)[0] + b",*")
+        elif c < 0.16:
+            keys.add(host + b",*")
+        elif c < 0.25:
+            keys.add(host + b")")
+        else:
+            path = b"/".join(r.choice(segments) for _ in range(r.randrange(0, 3)))
+            key = host + b")/" + path
+            if r.random() < 0.3:
+                key += b"/*" if path else b"*"
+            keys.add(key)
+    return sorted(keys)
+
+
+@pytest.mark.parametrize("streams, expected", [
+    ([[b"com,cnn)/%7e/b 1\n", b"com,cnn)/* 2\n"], [b"com,cnn) 2\n"]], [b"com,cnn)/* 5\n"]),
+    ([[b"com,cnn)/news/$ 1\n", b"com,cnn)/news/% 1\n", b"com,cnn)/news/* 5\n"]], [b"com,cnn)/news/* 7\n"]),
+    ([[b"com,cnn) 1\n", b"com,cnn)/a 2\n"], [b"com,cnn,* 3\n", b"com,cnn,www)/ 4\n"]], [b"com,cnn,* 10\n"]),
+    ([[b"com,cnn)/a 1\n", b"com,cnn)/b 2\n"], [b"com,cnn)/a 3\n", b"org,cnn)/ 4\n"]], [b"com,cnn)/a 4\n", b"com,cnn)/b 2\n", b"org,cnn)/ 4\n"]),
+])
+def test_merge_cases(streams, expected):
+    assert list(merge_iter([iter(stream) for stream in streams])) == expected
+    assert reference(streams) == expected
+
+
+def test_merge_headers():
+    counts = {}
+    merged = list(merge_iter([iter([b"!meta a\n", b"com,cnn)/ 1\n"]), iter([b"!meta a\r\n", b"!meta b\n", b"com,cnn)/ 2\n"])], counts))
+    assert merged == [b"!meta a\n", b"!meta b\n", b"com,cnn)/ 3\n"]
+    assert counts["outlines"] == 3
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_merge_matches_reference(seed):
+    r = random.Random(seed)
+    streams = [[b"%s %d\n" % (key, r.randrange(1, 9)) for key in random_keys(r)] for _ in range(r.randrange(1, 4))]
+    assert list(merge_iter([iter(stream) for stream in streams])) == reference(streams)
@@ -0,0 +1,42 @@
+import json
+import os
+
+import pytest
+
+from mementomap.cli import compact, find_splits, generate, parallel_compact, parallel_generate
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    CASES = json.load(f)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: case["outfile"])
+@pytest.mark.parametrize("workers", [2, 4])
+def test_parallel_matches_serial(tmp_path, case, workers):
+    infile = os.path.join(DATA, case["infile"])
+    cdx = infile.endswith(".cdx")
+    assert len(find_splits(infile, workers, cdx=cdx, **case["params"])) > 2
+    outfile = str(tmp_path / "parallel.out")
+    res = (parallel_generate if cdx else parallel_compact)(infile, outfile, workers, **case["params"])
+    assert read(outfile) == read(os.path.join(DATA, case["outfile"]))
+    assert res == case["counts"]
+    serial = str(tmp_path / "serial.out")
+    with open(infile, "rb") as f:
+        assert (generate if cdx else compact)(f, serial, **case["params"]) == res
+    assert read(serial) == read(outfile)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd")
+def test_parallel_closes_shards(tmp_path):
+    infile = os.path.join(DATA, "sample.ukvs")
+    parallel_compact(infile, str(tmp_path / "warmup.out"), 4)
+    before = len(os.listdir("/proc/self/fd"))
+    for i in range(5):
+        parallel_compact(infile, str(tmp_path / f"{i}.out"), 4)
+    assert len(os.listdir("/proc/self/fd")) == before
+    assert sorted(os.listdir(tmp_path)) == sorted(["warmup.out"] + [f"{i}.out" for i in range(5)])
@@ -0,0 +1,184 @@
+import json
+import os
+
+import pytest
+
+from mementomap.cli import BloomFilter, MementoMapReader, StaleSidecarError, bin_search, build_bloom, build_index, generate, index_search, load_bloom, load_index, lookup
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    MMAPS = [os.path.join(DATA, case["outfile"]) for case in json.load(f)]
+
+
+def prepare(mmapfile, tmp_path):
+    # Compacted fixtures are not strictly sorted and can repeat a key, keep the first line of each key in byte order
+    lines = {}
+    with open(mmapfile, "rb") as f:
+        for line in f:
+            lines.setdefault(line.split()[0], line)
+    outfile = str(tmp_path / os.path.basename(mmapfile))
+    with open(outfile, "wb") as opf:
+        opf.write(b"!meta {}\n")
+        opf.writelines(lines[key] for key in sorted(lines))
+    return outfile
+
+
+def probes(mmapfile):
+    surts = ["aaa,b)/", "zzz,a)/"]
+    with open(mmapfile, "rb") as f:
+        for line in f:
+            if line[:1] != b"!":
+                base = line.split()[0].decode().rstrip("*").rstrip("/,")
+                surts.extend([base, base + "/a/b", base + "?x=1", base + "-x", base.split(")")[0] + ",www)/z"])
+    return surts
+
+
+def expected(mmapfile, surts):
+    with open(mmapfile, "rb") as f:
+        return [lookup(f, surt) for surt in surts]
+
+
+@pytest.mark.parametrize("mmapfile", MMAPS, ids=os.path.basename)
+@pytest.mark.parametrize("blocksize", [0, 1, 64])
+def test_index_lookup(tmp_path, mmapfile, blocksize):
+    mmapfile = prepare(mmapfile, tmp_path)
+    surts = probes(mmapfile)
+    plain = expected(mmapfile, surts)
+    assert any(plain) and not all(plain)
+    counts = build_index(mmapfile, blocksize=blocksize)
+    index = load_index(mmapfile)
+    assert counts["blocks"] == len(index[0]) and counts["outbytes"] == os.path.getsize(f"{mmapfile}.idx")
+    with open(mmapfile, "rb") as f:
+        data = f.read()
+        for key in [line.split()[0] for line in data.splitlines()[1:]] + [b"aaa", b"com,cnn)/zz", b"zzz"]:
+            assert index_search(data, index, key) == bin_search(f, key)
+    with MementoMapReader(mmapfile) as reader:
+        assert reader.index == index
+        assert [reader.lookup(surt) for surt in surts] == plain
+    with MementoMapReader(mmapfile, index=False) as reader:
+        assert reader.index is None
+        assert [reader.lookup(surt) for surt in surts] == plain
+
+
+@pytest.mark.parametrize("change", ["size", "mtime"])
+def test_stale_index(tmp_path, capsys, change):
+    mmapfile = prepare(MMAPS[0], tmp_path)
+    build_index(mmapfile, blocksize=0)
+    st = os.stat(mmapfile)
+    if change == "size":
+        with open(mmapfile, "ab") as f:
+            f.write(b"zzz,a)/ 1\n")
+        os.utime(mmapfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(mmapfile, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    with pytest.raises(StaleSidecarError, match="index"):
+        load_index(mmapfile)
+    with pytest.raises(StaleSidecarError):
+        MementoMapReader(mmapfile)
+    surts = probes(mmapfile)
+    with MementoMapReader.open_with_fallback(mmapfile) as reader:
+        assert reader.index is None
+        assert [reader.lookup(surt) for surt in surts] == expected(mmapfile, surts)
+    assert "falling back" in capsys.readouterr().err
+    build_index(mmapfile)
+    with MementoMapReader(mmapfile) as reader:
+        assert reader.index
+
+
+def test_invalid_index(tmp_path):
+    mmapfile = prepare(MMAPS[0], tmp_path)
+    with open(f"{mmapfile}.idx", "wb") as f:
+        f.write(b"com,a)/ 0\n")
+    with pytest.raises(StaleSidecarError):
+        load_index(mmapfile)
+
+
+@pytest.mark.parametrize("mmapfile", MMAPS, ids=os.path.basename)
+@pytest.mark.parametrize("index", [False, True])
+def test_bloom_lookup(tmp_path, mmapfile, index):
+    mmapfile = prepare(mmapfile, tmp_path)
+    surts = probes(mmapfile)
+    plain = expected(mmapfile, surts)
+    if index:
+        build_index(mmapfile, blocksize=0)
+    counts = build_bloom(mmapfile, fpr=0.01)
+    assert counts["outbytes"] == os.path.getsize(f"{mmapfile}.bloom")
+    bloom = load_bloom(mmapfile)
+    with open(mmapfile, "rb") as f:
+        keys = [line.split()[0] for line in f if line[:1] != b"!"]
+    assert counts["keys"] == len(keys) and all(key in bloom for key in keys)
+    with MementoMapReader(mmapfile, cache_size=0) as reader:
+        assert reader.bloom and bool(reader.index) == index
+        assert [reader.lookup(surt) for surt in surts] == plain
+        assert 0 < reader.skipped < reader.misses
+
+
+def test_bloom_false_positives():
+    bf = BloomFilter.sized(1000, 0.01)
+    for i in range(1000):
+        bf.add(b"com,a)/%d" % i)
+    assert all(b"com,a)/%d" % i in bf for i in range(1000))
+    assert sum(b"com,b)/%d" % i in bf for i in range(10000)) < 300
+
+
+def test_generate_bloom(tmp_path):
+    outfile = str(tmp_path / "out.ukvs")
+    with open(os.path.join(DATA, "sample.cdx"), "rb") as f:
+        counts = generate(f, outfile, hcf=0.3, pcf=0.5, bloom=0.01)
+    bloom = load_bloom(outfile)
+    with open(outfile, "rb") as f:
+        keys = [line.split()[0] for line in f]
+    assert len(keys) == counts["outlines"] and all(key in bloom for key in keys)
+    assert any(key.endswith(b"*") for key in keys)
+
+
+@pytest.mark.parametrize("change", ["size", "mtime"])
+def test_stale_bloom(tmp_path, capsys, change):
+    mmapfile = prepare(MMAPS[0], tmp_path)
+    build_bloom(mmapfile)
+    st = os.stat(mmapfile)
+    if change == "size":
+        with open(mmapfile, "ab") as f:
+            f.write(b"zzz,a)/ 1\n")
+        os.utime(mmapfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(mmapfile, ns=(st.st_atime_ns, st.st_mtime_ns - 10 ** 9))
+    with pytest.raises(StaleSidecarError, match="filter"):
+        load_bloom(mmapfile)
+    with pytest.raises(StaleSidecarError):
+        MementoMapReader(mmapfile, index=False)
+    surts = probes(mmapfile)
+    with MementoMapReader.open_with_fallback(mmapfile) as reader:
+        assert reader.bloom is None
+        assert [reader.lookup(surt) for surt in surts] == expected(mmapfile, surts)
+    assert "falling back" in capsys.readouterr().err
+
+
+def test_stats(tmp_path):
+    mmapfile = prepare(MMAPS[0], tmp_path)
+    surts = probes(mmapfile)
+    plain = expected(mmapfile, surts)
+    with MementoMapReader(mmapfile, cache_size=4096) as reader:
+        assert reader.stats() == {"hits": 0, "misses": 0, "skipped": 0, "cached": 0, "distances": {}}
+        assert [reader.lookup(surt) for surt in surts] == plain
+        first = reader.stats()
+        assert first["misses"] == first["cached"] > 0 and first["skipped"] == 0
+        assert sum(first["distances"].values()) == len(surts) and first["distances"]["miss"] == plain.count(None)
+        assert [reader.lookup(surt) for surt in surts] == plain
+        second = reader.stats()
+        assert second["misses"] == first["misses"] and second["cached"] == first["cached"]
+        assert second["hits"] == first["hits"] + first["hits"] + first["misses"]
+        assert second["distances"] == {k: 2 * n for k, n in first["distances"].items()}
+    build_bloom(mmapfile)
+    with MementoMapReader(mmapfile, cache_size=2) as reader:
+        assert [reader.lookup(surt) for surt in surts] == plain
+        stats = reader.stats()
+        assert stats["cached"] == 2 and 0 < stats["skipped"] < stats["misses"]
+        keys = list(reader.cache)
+        reader.search(keys[0])
+        assert reader.stats()["hits"] == stats["hits"] + 1 and list(reader.cache) == keys[::-1]
+    with MementoMapReader(mmapfile, cache_size=0) as reader:
+        for surt in surts[:3] * 2:
+            reader.lookup(surt)
+        stats = reader.stats()
+        assert stats["hits"] == stats["cached"] == 0 and stats["misses"] > 0
@@ -0,0 +1,128 @@
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+import pytest
+
+from mementomap.binary import write_binary
+from mementomap.server import MementoMapServer
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples", "sample-01.ukvs")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def served(tmp_path_factory):
+    mmapfile = str(tmp_path_factory.mktemp("serve") / "live.ukvs")
+    shutil.copy(SAMPLE, mmapfile)
+    server = MementoMapServer([f"sample={SAMPLE}", f"live={mmapfile}"], reload_interval=0.1)
+    port = free_port()
+    threading.Thread(target=server.serve, args=("127.0.0.1", port), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return server, port, mmapfile
+
+
+def request(port, method, target, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request(method, target, body)
+    res = conn.getresponse()
+    status, data = res.status, json.loads(res.read())
+    conn.close()
+    return status, data
+
+
+def test_lookup(served):
+    server, port, mmapfile = served
+    status, res = request(port, "GET", "/lookup?surt=com,cnn)/news/a/b/c&map=sample")
+    assert status == 200
+    assert res == {"sample": {"surtk": "com,cnn)/news/a/b/c", "freq": "5", "dist": "0", "surt": "com,cnn)/news/a/b/c"}}
+    status, res = request(port, "GET", "/lookup?surt=org,example)/")
+    assert status == 200
+    assert res == {"sample": None, "live": None}
+
+
+def test_batchlookup(served):
+    server, port, mmapfile = served
+    status, res = request(port, "POST", "/batchlookup?map=sample", b"com,cnn)/images\norg,example)/page\n\nedu,odu,cs)/~mln/pubs\n")
+    assert status == 200
+    assert [hit and hit["surtk"] for hit in res["sample"]] == ["com,cnn)/images", None, "edu,odu,cs)/~mln/pubs"]
+
+
+def test_errors(served):
+    server, port, mmapfile = served
+    assert request(port, "GET", "/lookup?surt=edu,psu)/&map=missing") == (404, {"error": "Unknown MementoMap missing"})
+    assert request(port, "GET", "/nowhere")[0] == 404
+    assert request(port, "POST", "/lookup?surt=edu,psu)/", b"")[0] == 405
+    assert request(port, "GET", "/batchlookup")[0] == 405
+    assert request(port, "GET", "/lookup") == (400, {"error": "Missing surt parameter"})
+    assert request(port, "POST", "/batchlookup", b"\xff\xfe")[0] == 400
+
+
+def test_keepalive(served):
+    server, port, mmapfile = served
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    for surt in ["com,cnn)/images", "com,news)/foo", "edu,odu)/compsci"]:
+        conn.request("GET", f"/lookup?surt={surt}&map=sample")
+        res = conn.getresponse()
+        assert res.status == 200
+        assert res.getheader("Connection") == "keep-alive"
+        assert json.loads(res.read())["sample"]["surtk"] == surt
+    sock = conn.sock
+    conn.request("GET", "/stats")
+    res = conn.getresponse()
+    stats = json.loads(res.read())
+    assert conn.sock is sock
+    assert stats["maps"]["sample"]["lookups"] >= 3
+    conn.close()
+
+
+def test_reload(served):
+    server, port, mmapfile = served
+    assert request(port, "GET", "/lookup?surt=org,example)/page&map=live")[1] == {"live": None}
+    with open(mmapfile + ".new", "w") as f:
+        f.write("org,example)/page 7\n")
+    os.replace(mmapfile + ".new", mmapfile)
+    for _ in range(50):
+        time.sleep(0.1)
+        status, res = request(port, "GET", "/lookup?surt=org,example)/page&map=live")
+        if res["live"]:
+            break
+    assert res["live"]["freq"] == "7"
+    assert server.maps["live"].counts["reloads"] == 1
+
+
+def test_reload_partial_binary(served, capfd):
+    server, port, mmapfile = served
+    data = io.BytesIO()
+    write_binary(iter([b"org,example)/page 9\n"]), data)
+    with open(mmapfile + ".new", "wb") as f:
+        f.write(data.getvalue()[:40])
+    os.replace(mmapfile + ".new", mmapfile)
+    time.sleep(0.5)
+    assert request(port, "GET", "/lookup?surt=org,example)/page&map=live")[1]["live"]["freq"] == "7"
+    assert "Truncated binary MementoMap" in capfd.readouterr().err
+    with open(mmapfile + ".new", "wb") as f:
+        f.write(data.getvalue())
+    os.replace(mmapfile + ".new", mmapfile)
+    for _ in range(50):
+        time.sleep(0.1)
+        status, res = request(port, "GET", "/lookup?surt=org,example)/page&map=live")
+        if res["live"]["freq"] != "7":
+            break
+    assert res["live"]["freq"] == "9"
+    assert server.maps["live"].counts["reloads"] == 2
@@ -0,0 +1,64 @@
+import json
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from mementomap.cli import cdx2hxpx, compact, generate, sort_keys, update
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    PARAMS = [case["params"] for case in json.load(f) if case["infile"] == "sample.cdx"]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def cdx_lines(copies=1):
+    # Repeat the fixture past the 1 MB sort chunks, in the order of the keys without queries
+    with open(os.path.join(DATA, "sample.cdx"), "rb") as f:
+        lines = f.readlines() * copies
+    return sorted(lines, key=lambda line: line.split()[0].split(b"?")[0].strip(b"/,"))
+
+
+@pytest.fixture(scope="module")
+def shuffled(tmp_path_factory):
+    lines = cdx_lines(100)
+    random.Random(0).shuffle(lines)
+    infile = str(tmp_path_factory.mktemp("sort") / "shuffled.cdx")
+    with open(infile, "wb") as f:
+        f.writelines(lines)
+    return infile
+
+
+@pytest.mark.parametrize("params", PARAMS, ids=str)
+@pytest.mark.parametrize("workers, fanin", [(1, 256), (2, 256), (2, 2)])
+def test_sort_matches_sorted_generate(tmp_path, shuffled, params, workers, fanin):
+    sortfile, serial = str(tmp_path / "sorted.ukvs"), str(tmp_path / "serial.ukvs")
+    with open(shuffled, "rb") as f:
+        counts = compact(sort_keys(f, cdx=True, memory=2 << 20, workers=workers, tmpdir=str(tmp_path), fanin=fanin), sortfile, **params)
+    assert counts == generate(iter(cdx_lines(100)), serial, **params)
+    assert read(sortfile) == read(serial)
+    assert sorted(os.listdir(tmp_path)) == ["serial.ukvs", "sorted.ukvs"]
+
+
+def test_sort_cli(tmp_path, shuffled):
+    outfile, serial = str(tmp_path / "sorted.ukvs"), str(tmp_path / "serial.ukvs")
+    res = subprocess.run([sys.executable, "-m", "mementomap", "generate", shuffled, outfile, "--sort", "--workers", "2", "--memory", "2", "--hcf", "0.1", "--pcf", "0.1"], stdout=subprocess.PIPE, check=True)
+    counts = generate(iter(cdx_lines(100)), serial, hcf=0.1, pcf=0.1)
+    assert res.stdout.split() == [b"%d" % counts[k] for k in ["inlines", "outlines", "inbytes", "outbytes", "rollups"]]
+    assert read(outfile) == read(serial)
+
+
+def test_sorted_update_delta(tmp_path, shuffled):
+    mmapfile, updated, full = str(tmp_path / "base.ukvs"), str(tmp_path / "updated.ukvs"), str(tmp_path / "full.ukvs")
+    generate(iter(cdx_lines()), mmapfile)
+    with open(shuffled, "rb") as f:
+        counts = update(mmapfile, sort_keys(f, cdx=True, memory=2 << 20, workers=2), updated)
+    assert counts["inbytes"] == sum(len(line) for line in cdx2hxpx(cdx_lines(100)))
+    generate(iter(cdx_lines(101)), full)
+    assert read(updated) == read(full)
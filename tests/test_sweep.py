@@ -0,0 +1,45 @@
+import json
+import os
+
+import pytest
+
+from mementomap.__main__ import run_sweep
+from mementomap.cli import compact, sweep
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+INFILE = os.path.join(DATA, "sample.ukvs")
+with open(os.path.join(DATA, "expected.json")) as f:
+    CASES = [case for case in json.load(f) if case["infile"] == "sample.ukvs"]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("depths", [{}, {"hdepth": 2, "pdepth": 3}, {"hdepth": 2, "pdepth": 2}])
+def test_sweep_matches_compact(tmp_path, depths):
+    settings = [(1.0, 1.0), (0.01, 0.01), (float("inf"), 0.2)]
+    for case in CASES:
+        params = dict(case["params"])
+        if {k: params.pop(k) for k in ["hdepth", "pdepth"] if k in params} == depths:
+            settings.append((params["hcf"], params["pcf"]))
+    outfiles = [str(tmp_path / f"sweep-{i}.ukvs") for i in range(len(settings))]
+    with open(INFILE, "rb") as f:
+        table = sweep(f, outfiles, settings, **depths)
+    assert [(res["hcf"], res["pcf"]) for res in table] == settings
+    for (hcf, pcf), res, outfile in zip(settings, table, outfiles):
+        single = str(tmp_path / "single.ukvs")
+        with open(INFILE, "rb") as f:
+            counts = compact(f, single, hcf, pcf, **depths)
+        assert dict(res, hcf=hcf, pcf=pcf) == dict(counts, hcf=hcf, pcf=pcf)
+        assert read(outfile) == read(single)
+        for case in CASES:
+            if case["params"] == dict(depths, hcf=hcf, pcf=pcf):
+                assert read(outfile) == read(os.path.join(DATA, case["outfile"]))
+
+
+def test_sweep_workers_need_sort(tmp_path):
+    with pytest.raises(ValueError, match="--workers"):
+        run_sweep(infile=INFILE, outfile=str(tmp_path / "out.ukvs"), sweep=[(1.0, 1.0)], workers=2, sort=False)
+    assert not os.listdir(tmp_path)
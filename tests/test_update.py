@@ -0,0 +1,76 @@
+import io
+import json
+import os
+import random
+
+import pytest
+
+from mementomap.binary import write_binary
+from mementomap.cli import cdx2hxpx, generate, update
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+with open(os.path.join(DATA, "expected.json")) as f:
+    PARAMS = [{"hcf": float("inf"), "pcf": float("inf")}] + [case["params"] for case in json.load(f) if case["infile"] == "sample.cdx"]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def cdx_lines():
+    # The fixture is sorted by raw CDX key, generate and update need the order of the keys without queries
+    with open(os.path.join(DATA, "sample.cdx"), "rb") as f:
+        return sorted(f, key=lambda line: line.split()[0].split(b"?")[0].strip(b"/,"))
+
+
+@pytest.mark.parametrize("params", PARAMS, ids=str)
+@pytest.mark.parametrize("seed, share", [(0, 0.3), (1, 0.05), (2, 0.9)])
+def test_update_matches_generate(tmp_path, params, seed, share):
+    lines = cdx_lines()
+    r = random.Random(seed)
+    picked = [r.random() < share for _ in lines]
+    base = [line for line, pick in zip(lines, picked) if not pick]
+    delta = [line for line, pick in zip(lines, picked) if pick]
+    mmapfile, updated, full = str(tmp_path / "base.ukvs"), str(tmp_path / "updated.ukvs"), str(tmp_path / "full.ukvs")
+    generate(iter(base), mmapfile, **params)
+    counts = update(mmapfile, cdx2hxpx(delta), updated, **params)
+    expected = generate(iter(lines), full, **params)
+    assert read(updated) == read(full)
+    assert counts["outlines"] == expected["outlines"] and counts["outbytes"] == expected["outbytes"]
+    assert counts["inlines"] == len(set(line.split()[0] for line in cdx2hxpx(delta))) and counts["subtrees"] > 0
+
+
+def test_update_empty_delta(tmp_path):
+    mmapfile, updated = str(tmp_path / "base.ukvs"), str(tmp_path / "updated.ukvs")
+    generate(iter(cdx_lines()), mmapfile)
+    counts = update(mmapfile, iter([]), updated)
+    assert read(updated) == read(mmapfile)
+    assert counts["subtrees"] == 0 and counts["copied"] == os.path.getsize(mmapfile)
+
+
+def test_update_unsorted_delta(tmp_path):
+    mmapfile = str(tmp_path / "base.ukvs")
+    generate(iter(cdx_lines()), mmapfile)
+    with pytest.raises(ValueError, match="not sorted"):
+        update(mmapfile, iter([b"org,a)/ 1", b"com,a)/ 1"]), str(tmp_path / "updated.ukvs"))
+
+
+def test_update_in_place(tmp_path):
+    mmapfile = str(tmp_path / "base.ukvs")
+    generate(iter(cdx_lines()), mmapfile)
+    before = read(mmapfile)
+    with pytest.raises(ValueError, match="in place"):
+        update(mmapfile, iter([b"com,a)/ 1"]), mmapfile)
+    os.link(mmapfile, str(tmp_path / "link.ukvs"))
+    with pytest.raises(ValueError, match="in place"):
+        update(mmapfile, iter([b"com,a)/ 1"]), str(tmp_path / "link.ukvs"))
+    assert read(mmapfile) == before
+
+
+def test_update_binary(tmp_path):
+    mmapfile = str(tmp_path / "base.bin")
+    with open(mmapfile, "wb") as opf:
+        write_binary([b"com,a)/ 1\n"], opf)
+    with pytest.raises(ValueError, match="binary"):
+        update(mmapfile, iter([b"com,a)/ 1"]), io.BytesIO())